@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+'''
+asyncio transport used by the async exchanges.
+
+Written against trollius so it runs on the same interpreter as the rest of
+the package; coroutines therefore use ``yield From(...)`` and
+``raise Return(...)`` instead of ``await``/``return``.
+'''
+
+import os
+import socket
+import time
+import urllib
+
+import trollius as asyncio
+from trollius import From, Return
+
+from connection import PROXY_RE
+from retry import RetryPolicy
+from transport import TRANSPORTS
+from xcptions import APIResponseError
+
+
+class AsyncConnection(object):
+    '''
+    Keeps up to ``pool_size`` keep-alive HTTPS streams to the broker's
+    DOMAIN and multiplexes requests from one event loop over them.
+
+    Streams are bound to their loop, so they are kept here rather than in
+    transport.TRANSPORTS; the SSLContext defaults to the registry's.  No
+    Cloudflare cookies are sent, as the blocking Connection only sends
+    them on request.
+    '''
+
+    def __init__(self, broker, timeout=30, pool_size=100, loop=None,
+                 retry=None, context=None):
+        self._timeout = timeout
+        self.retry = retry or RetryPolicy()
+        self._loop = loop or asyncio.get_event_loop()
+        self.headers = broker.HEADER
+        self._broker = broker
+        self.domain = broker.DOMAIN
+        self._ssl = context if context is not None else TRANSPORTS.context
+        self._slots = asyncio.Semaphore(pool_size, loop=self._loop)
+        self._idle = []
+
+
+    def _tunnel(self, host, port):
+        # blocking CONNECT handshake, run in the loop's executor
+        sock = socket.create_connection((host, port), self._timeout)
+        try:
+            sock.sendall("CONNECT %s:443 HTTP/1.0\r\n\r\n" % self.domain)
+            reply = ""
+            while "\r\n\r\n" not in reply:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                reply += chunk
+            status = reply.split(" ", 2)
+            if len(status) < 2 or status[1] != "200":
+                raise APIResponseError("Proxy tunnel failed: %r"
+                                       % reply.split("\r\n", 1)[0])
+        except Exception:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        return sock
+
+
+    @asyncio.coroutine
+    def _open(self):
+        proxy = os.environ.get("HTTPS_PROXY")
+        match = PROXY_RE.search(proxy) if proxy else None
+        if match:
+            sock = yield From(self._loop.run_in_executor(
+                None, self._tunnel, match.group(1), int(match.group(2))))
+            stream = yield From(asyncio.open_connection(
+                sock=sock, ssl=self._ssl, server_hostname=self.domain,
+                loop=self._loop))
+        else:
+            stream = yield From(asyncio.open_connection(
+                self.domain, 443, ssl=self._ssl, loop=self._loop))
+        raise Return(stream)
+
+
+    @asyncio.coroutine
+    def _checkout(self):
+        yield From(self._slots.acquire())
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof():
+                raise Return((reader, writer))
+            writer.close()
+        try:
+            stream = yield From(self._open())
+        except Exception:
+            self._slots.release()
+            raise
+        raise Return(stream)
+
+
+    def _checkin(self, stream, reusable=True):
+        if reusable:
+            self._idle.append(stream)
+        else:
+            stream[1].close()
+        self._slots.release()
+
+
+    @asyncio.coroutine
+    def _readResponse(self, reader):
+        status_line = yield From(reader.readline())
+        if not status_line:
+            raise APIResponseError("Connection closed by %s" % self.domain)
+        status = int(status_line.split(" ", 2)[1])
+
+        headers = {}
+        while True:
+            line = yield From(reader.readline())
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((yield From(reader.readline())).split(";")[0], 16)
+                if size == 0:
+                    yield From(reader.readline())
+                    break
+                chunks.append((yield From(reader.readexactly(size))))
+                yield From(reader.readline())
+            body = "".join(chunks)
+        elif "content-length" in headers:
+            body = yield From(reader.readexactly(
+                int(headers["content-length"])))
+        else:
+            body = yield From(reader.read())
+            headers["connection"] = "close"
+
+        keep_alive = headers.get("connection", "").lower() != "close"
+        raise Return((status, body, keep_alive))
+
+
+    @asyncio.coroutine
+    def _attempt(self, request, progress):
+        # progress[0] turns True once the request may have reached the server
+        reader, writer = yield From(self._checkout())
+        try:
+            progress[0] = True
+            writer.write(request)
+            yield From(writer.drain())
+            status, body, keep_alive = yield From(self._readResponse(reader))
+        except BaseException:
+            self._checkin((reader, writer), reusable=False)
+            raise
+
+        self._checkin((reader, writer), reusable=keep_alive)
+        raise Return((status, body))
+
+
+    @asyncio.coroutine
+    def makeRequest(self, url, params={}, extra_headers=None,
+                    idempotent=None, retry=None, deadline=None):
+        """
+        Coroutine version of Connection.makeRequest with the same retry
+        semantics.
+        """
+        if idempotent is None:
+            idempotent = extra_headers is None
+        policy = retry or self.retry
+
+        # signed private requests arrive already encoded
+        if isinstance(params, basestring):
+            data = params
+        else:
+            data = urllib.urlencode(params)
+        headers = dict(self.headers)
+        if extra_headers is not None:
+            headers.update(extra_headers)
+        headers["Host"] = self.domain
+        headers["Content-Length"] = str(len(data))
+
+        request = ["POST %s HTTP/1.1" % url]
+        request.extend("%s: %s" % item for item in headers.iteritems())
+        request.append("")
+        request.append(data)
+        request = "\r\n".join(request)
+
+        started = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            timeout = self._timeout
+            left = policy.remaining(started, deadline)
+            if left is not None:
+                timeout = max(min(timeout, left), 0.001)
+
+            progress = [False]
+            try:
+                status, body = yield From(asyncio.wait_for(
+                    self._attempt(request, progress), timeout,
+                    loop=self._loop))
+                if not 200 <= status <= 299:
+                    raise APIResponseError("API response error: %s" % status,
+                                           status)
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    e = socket.timeout("Request to %s timed out after %ss"
+                                       % (url, timeout))
+                wait = policy.nextDelay(e, attempt, idempotent, progress[0],
+                                        started, deadline)
+                if wait is None:
+                    raise e
+                yield From(asyncio.sleep(wait, loop=self._loop))
+                continue
+
+            raise Return(body)
+
+
+    def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
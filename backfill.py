@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from Queue import Queue
+
+import multiprocessing
+import re
+import threading
+
+
+# the cursor of a Trades/OHLC/Spread body, found without parsing it
+LAST_RE = re.compile(r'"last"\s*:\s*"?(\d+)')
+
+_DONE = object()
+
+
+def cursorOf(body):
+    """
+    The ``last`` cursor of a raw response body as a string, or None.
+    """
+    match = LAST_RE.search(body)
+    return match.group(1) if match else None
+
+
+class Backfill(object):
+    '''
+    Parses the pages of large backfills in a process pool.
+
+    For every pair a thread fetches the raw pages one after another,
+    following the ``last`` cursor read from the body by a regular
+    expression, while the pool's ``processes`` workers parse the pages
+    already fetched.  Workers get the raw bodies and send back columnar
+    batches, which pickle as a few flat buffers rather than one object per
+    row.  At most ``backlog`` pages are fetched but not yet consumed, so
+    memory stays bounded.  Use it as a context manager or close() it.
+    '''
+
+    def __init__(self, processes=None, backlog=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.backlog = backlog or 2 * self.processes
+        self._pool = multiprocessing.Pool(self.processes)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *_args):
+        self.close()
+
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+    def pages(self, pairs, fetch, parse, since=None, stop=None):
+        """
+        Yields (pair, result) for every page of every pair, in page order
+        per pair.  ``since`` is the first cursor, or a dict of cursors per
+        pair.  ``fetch(pair, cursor)`` returns a raw body and runs in a
+        thread; ``parse(pair, body)`` runs in a worker and must be
+        picklable, e.g. a module level function or a functools.partial of
+        one.  A pair is done when its cursor stops advancing or
+        ``stop(cursor)`` is true.  Exceptions of fetch and parse are raised
+        here.
+        """
+        pairs = list(pairs)
+        queue = Queue(self.backlog)
+        closed = threading.Event()
+
+        def run(pair):
+            cursor = since.get(pair) if isinstance(since, dict) else since
+            try:
+                while not closed.is_set():
+                    body = fetch(pair, cursor)
+                    queue.put((pair, self._pool.apply_async(parse,
+                                                            (pair, body))))
+                    last = cursorOf(body)
+                    if last is None or last == str(cursor) or (
+                            stop is not None and stop(last)):
+                        break
+                    cursor = last
+            except Exception as e:
+                queue.put((pair, e))
+            queue.put((pair, _DONE))
+
+        threads = [threading.Thread(target=run, args=(pair,))
+                   for pair in pairs]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        running = len(threads)
+        try:
+            while running:
+                pair, item = queue.get()
+                if item is _DONE:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield pair, item.get()
+        finally:
+            closed.set()
+            # unblock fetch threads waiting for room in the queue
+            while any(t.is_alive() for t in threads):
+                while not queue.empty():
+                    queue.get()
+                for t in threads:
+                    t.join(0.01)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from heapq import heappop, heappush
+from exchange import OHLCV
+
+
+class _Bar(object):
+    __slots__ = ("start", "open", "high", "low", "close", "volume",
+                 "notional", "first", "updated")
+
+    def __init__(self, start, time, price, amount):
+        self.start = start
+        self.open = self.high = self.low = self.close = price
+        self.volume = amount
+        self.notional = price * amount
+        self.first = self.updated = time
+
+    def toOHLCV(self, pair):
+        return OHLCV(pair=pair, open=self.open, high=self.high, low=self.low,
+                     close=self.close, volume=self.volume,
+                     avg=self.notional / self.volume if self.volume
+                         else self.close,
+                     updated=self.updated, date=self.start)
+
+
+class _PairState(object):
+    __slots__ = ("watermark", "bars", "due")
+
+    def __init__(self, intervals):
+        self.watermark = float("-inf")
+        # open bars per interval, keyed by their start time
+        self.bars = [{} for _ in intervals]
+        # (end, interval index, start) of every open bar
+        self.due = []
+
+
+class BarBuilder(object):
+    '''
+    Builds OHLCV bars incrementally from trades, for several intervals and
+    any number of pairs at once.
+
+    ``intervals`` are bar lengths in seconds, fractions allowed.  Every
+    trade updates the open bar of each interval in constant time.  A bar
+    closes once a trade of the same pair arrives ``lateness`` seconds past
+    its end; until then late trades still count, with open and close
+    taken from the earliest and latest trade by time.  Trades older than
+    that are dropped and counted in ``dropped``.  Closed bars are passed
+    to ``on_bar(interval, ohlcv)`` or, without a callback, collected for
+    closed().  ``OHLCV.avg`` is the volume weighted average price; empty
+    intervals produce no bar.
+    '''
+
+    def __init__(self, intervals=(60,), lateness=0.0, on_bar=None):
+        self.intervals = tuple(intervals)
+        self.lateness = lateness
+        self.on_bar = on_bar
+        self.dropped = 0
+        self._pairs = {}
+        self._closed = []
+
+
+    def add(self, pair, time, price, amount):
+        """
+        Adds one trade given as epoch time, price and volume.
+        """
+        state = self._pairs.get(pair)
+        if state is None:
+            state = self._pairs[pair] = _PairState(self.intervals)
+        elif time + self.lateness < state.watermark:
+            self.dropped += 1
+            return
+
+        index = 0
+        for interval in self.intervals:
+            start = time - time % interval
+            bars = state.bars[index]
+            bar = bars.get(start)
+            if bar is None:
+                bars[start] = _Bar(start, time, price, amount)
+                heappush(state.due, (start + interval, index, start))
+            else:
+                if price > bar.high:
+                    bar.high = price
+                elif price < bar.low:
+                    bar.low = price
+                if time >= bar.updated:
+                    bar.close = price
+                    bar.updated = time
+                elif time < bar.first:
+                    bar.open = price
+                    bar.first = time
+                bar.volume += amount
+                bar.notional += price * amount
+            index += 1
+
+        if time > state.watermark:
+            state.watermark = time
+            if state.due[0][0] + self.lateness <= time:
+                self._close(pair, state, time - self.lateness)
+
+
+    def addTrade(self, trade):
+        """
+        Adds an exchange.Trade or a columnar.TradeView.
+        """
+        self.add(trade.pair, trade.epoch, float(trade.price),
+                 float(trade.amount))
+
+
+    def addBatch(self, batch):
+        """
+        Adds all trades of a columnar.TradeBatch.
+        """
+        add = self.add
+        pair = batch.pair
+        for t, price, amount in zip(batch.times, batch.prices,
+                                    batch.amounts):
+            add(pair, float(t), float(price), float(amount))
+
+
+    def _close(self, pair, state, until):
+        # closes the bars of ``pair`` ending at or before ``until``
+        due = state.due
+        while due and due[0][0] <= until:
+            end, index, start = heappop(due)
+            ohlcv = state.bars[index].pop(start).toOHLCV(pair)
+            if self.on_bar is not None:
+                self.on_bar(self.intervals[index], ohlcv)
+            else:
+                self._closed.append((self.intervals[index], ohlcv))
+
+
+    def flush(self, now=None):
+        """
+        Closes the bars that ended ``lateness`` seconds before the epoch
+        time ``now``, for quiet pairs, or all open bars if ``now`` is None.
+        """
+        until = float("inf") if now is None else now - self.lateness
+        for pair, state in self._pairs.iteritems():
+            self._close(pair, state, until)
+
+
+    def closed(self):
+        """
+        Returns and forgets the (interval, OHLCV) tuples of the bars closed
+        so far, when no on_bar callback is set.
+        """
+        closed, self._closed = self._closed, []
+        return closed
+
+
+    def openBars(self, pair):
+        """
+        The bars of ``pair`` still open, as (interval, OHLCV) tuples.
+        """
+        state = self._pairs.get(pair)
+        if state is None:
+            return []
+        return [(self.intervals[index], bar.toOHLCV(pair))
+                for index, bars in enumerate(state.bars)
+                for bar in bars.itervalues()]
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+'''
+Offline benchmark suite against the local Kraken stand-in.
+
+Starts benchmarks/standin.py in a child process and measures requests per
+second with p50/p99 latencies for public and signed private queries,
+backfill throughput per number of parsing processes, parse throughput of
+the decoder and the model classes, and signing throughput.  Results are
+printed and saved as JSON; with --baseline the run is compared against
+an earlier result file.  Run from the repository root:
+
+    python benchmarks/bench_api.py [--output results.json]
+                                   [--baseline old.json]
+'''
+
+from __future__ import print_function
+
+import argparse
+import functools
+import httplib
+import json
+import multiprocessing
+import os
+import platform
+import ssl
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "kraken"), ROOT]
+
+from backfill import Backfill
+from columnar import OHLCVFrame, TradeBatch
+from connection import Connection
+from decoder import Decoder
+from exchange import OHLCV, Trade
+from kraken import KrakenExchange, KrakenKeyHandler
+from standin import KEY, PAIR, PAIRS, SECRET, StandinServer, loadResponses
+
+
+# command, params of the measured queries
+PUBLIC_QUERIES = (
+    ("Ticker", {"pair": ",".join(PAIRS)}),
+    ("Depth", {"pair": PAIR, "count": 100}),
+    ("Trades", {"pair": PAIR}),
+    ("OHLC", {"pair": PAIR}),
+)
+PRIVATE_QUERIES = (
+    ("Balance", {}),
+    ("AddOrder", {"pair": PAIR, "type": "buy", "ordertype": "limit",
+                  "price": "612.3", "volume": "1.25"}),
+)
+# metrics where lower is better, for the baseline comparison
+LOWER_IS_BETTER = ("p50_ms", "p99_ms")
+
+
+class BenchKeyHandler(KrakenKeyHandler):
+    def _loadKeys(self):
+        self.filename = None
+        self.addKey(KEY, SECRET, 1)
+
+
+class StandinExchange(KrakenExchange):
+    '''
+    KrakenExchange talking to the stand-in at ``domain``.
+    '''
+
+    def __init__(self, domain, connection_class, pool_size, *args, **kwargs):
+        self.DOMAIN = domain
+        self._connection_class = connection_class
+        self._pool_size = pool_size
+        KrakenExchange.__init__(self, *args, **kwargs)
+
+    def _setupConnection(self):
+        self.connection = Connection(self, pool_size=self._pool_size,
+                                     connection_class=self._connection_class)
+
+
+def serve(ports, responses, certfile):
+    server = StandinServer(0, loadResponses(responses), certfile=certfile)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def measureRequests(query, count, threads):
+    """
+    Runs ``query`` ``count`` times over ``threads`` threads; returns
+    requests/s and latency percentiles.
+    """
+    latencies = []
+    errors = []
+    per_thread = max(1, count // threads)
+
+    def run():
+        local = []
+        try:
+            for _ in xrange(per_thread):
+                start = time.time()
+                query()
+                local.append(time.time() - start)
+        except Exception as e:
+            errors.append(e)
+        latencies.extend(local)
+
+    workers = [threading.Thread(target=run) for _ in xrange(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+
+    return {"requests": len(latencies),
+            "requests_per_s": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000}
+
+
+def measureRate(func, count, unit):
+    start = time.time()
+    func(count)
+    elapsed = time.time() - start
+    return {unit + "_per_s": count / elapsed}
+
+
+def benchRequests(exchange, count, threads):
+    results = {}
+    for command, params in PUBLIC_QUERIES:
+        results["public." + command] = measureRequests(
+            lambda: exchange.publicQuery(command, **params), count, threads)
+    for command, params in PRIVATE_QUERIES:
+        results["private." + command] = measureRequests(
+            lambda: exchange.privateQuery(command, **params), count, threads)
+    return results
+
+
+def benchBackfill(exchange, pairs, processes):
+    """
+    Backfills the trades of ``pairs`` stand-in pairs once per entry of
+    ``processes``, the sizes of the parsing pool.
+    """
+    pairs = ["P%04d" % i for i in xrange(pairs)]
+    results = {}
+    for n in processes:
+        rows = pages = 0
+        start = time.time()
+        with Backfill(n) as backfill:
+            for _, batch, _ in exchange.backfillTrades(pairs,
+                                                       backfill=backfill):
+                rows += len(batch)
+                pages += 1
+        elapsed = time.time() - start
+        results["backfill.processes=%d" % n] = {"pages_per_s": pages / elapsed,
+                                                "rows_per_s": rows / elapsed}
+    return results
+
+
+def benchParsing(responses, count):
+    decoder = Decoder()
+    results = {}
+    for command, _ in PUBLIC_QUERIES:
+        body = responses[command]
+
+        def decode(n):
+            for _ in xrange(n):
+                decoder.decode(body)
+
+        result = measureRate(decode, count, "bodies")
+        result["mb_per_s"] = result["bodies_per_s"] * len(body) / 1e6
+        results["decode." + command] = result
+
+    trades = decoder.decode(responses["Trades"])["result"][PAIR]
+    ohlc = decoder.decode(responses["OHLC"])["result"][PAIR]
+    rows = max(1, count // 10)
+
+    def tradeObjects(n):
+        for _ in xrange(n):
+            [Trade(pair=PAIR, price=float(r[0]), amount=float(r[1]),
+                   date=r[2], trade_type=r[3]) for r in trades]
+
+    def tradeBatches(n):
+        for _ in xrange(n):
+            TradeBatch.fromKraken(PAIR, trades)
+
+    def ohlcvObjects(n):
+        for _ in xrange(n):
+            [OHLCV(pair=PAIR, open=float(r[1]), high=float(r[2]),
+                   low=float(r[3]), close=float(r[4]), avg=float(r[5]),
+                   volume=float(r[6]), date=r[0], updated=r[0])
+             for r in ohlc]
+
+    def ohlcvFrames(n):
+        for _ in xrange(n):
+            OHLCVFrame.fromKraken(PAIR, ohlc)
+
+    for name, func, size in (("model.Trade", tradeObjects, len(trades)),
+                             ("columnar.TradeBatch", tradeBatches,
+                              len(trades)),
+                             ("model.OHLCV", ohlcvObjects, len(ohlc)),
+                             ("columnar.OHLCVFrame", ohlcvFrames,
+                              len(ohlc))):
+        result = measureRate(func, rows, "pages")
+        result["rows_per_s"] = result["pages_per_s"] * size
+        results[name] = result
+    return results
+
+
+def benchSigning(handler, count):
+    params = dict(PRIVATE_QUERIES[1][1])
+
+    def sign(n):
+        for _ in xrange(n):
+            handler.authRequest(KEY, "/0/private/AddOrder", params)
+
+    return {"authRequest": measureRate(sign, count, "signatures")}
+
+
+def compare(results, baseline):
+    print("\n%-28s %-16s %12s %12s %8s" % ("benchmark", "metric", "baseline",
+                                          "current", "change"))
+    for name, metrics in sorted(results.iteritems()):
+        old = baseline.get(name, {})
+        for metric, value in sorted(metrics.iteritems()):
+            if not old.get(metric) or not (metric.endswith("_per_s") or
+                                           metric in LOWER_IS_BETTER):
+                continue
+            change = (value - old[metric]) / old[metric] * 100
+            if metric in LOWER_IS_BETTER:
+                change = -change
+            print("%-28s %-16s %12.1f %12.1f %+7.1f%%"
+                  % (name, metric, old[metric], value, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="requests per measured query")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="iterations of the parse benchmarks")
+    parser.add_argument("--signatures", type=int, default=50000)
+    parser.add_argument("--backfill-pairs", type=int, default=200,
+                        help="pairs of the backfill benchmark")
+    parser.add_argument("--processes", type=int, nargs="+",
+                        default=sorted(set([1, multiprocessing.cpu_count()])),
+                        help="parsing pool sizes of the backfill benchmark")
+    parser.add_argument("--responses", help="directory of recorded bodies")
+    parser.add_argument("--certfile", help="serve HTTPS with this PEM")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare with a result file")
+    args = parser.parse_args()
+
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(ports,
+                                                         args.responses,
+                                                         args.certfile))
+    server.daemon = True
+    server.start()
+    port = ports.get(timeout=10)
+
+    if args.certfile:
+        connection_class = functools.partial(
+            httplib.HTTPSConnection,
+            context=ssl._create_unverified_context())
+    else:
+        connection_class = httplib.HTTPConnection
+
+    handler = BenchKeyHandler(resaveOnDeletion=True)
+    exchange = StandinExchange("127.0.0.1:%d" % port, connection_class,
+                               args.threads, KEY, handler)
+    responses = loadResponses(args.responses)
+
+    results = {}
+    try:
+        results.update(benchRequests(exchange, args.requests, args.threads))
+        results.update(benchBackfill(exchange, args.backfill_pairs,
+                                     args.processes))
+    finally:
+        exchange.connection.close()
+        server.terminate()
+    results.update(benchParsing(responses, args.iterations))
+    results.update(benchSigning(handler, args.signatures))
+
+    for name, metrics in sorted(results.iteritems()):
+        print("%-28s %s" % (name, "  ".join("%s=%.1f" % item for item
+                                            in sorted(metrics.iteritems()))))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "https": bool(args.certfile),
+                       "time": time.time(),
+                       "results": results}, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main()
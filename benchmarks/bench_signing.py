@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+'''
+Signing throughput of KrakenKeyHandler.authRequest.
+
+Compares the pre-keyed signer against building a fresh HMAC per request
+(the previous implementation) and against signBatch.  Run from the
+repository root:
+
+    python benchmarks/bench_signing.py [requests]
+'''
+
+from __future__ import print_function
+
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import time
+import urllib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "kraken"), ROOT]
+
+from kraken import KrakenKeyHandler
+
+
+KEY = "benchmark-key"
+SECRET = base64.b64encode("s" * 64)
+URL = "/0/private/AddOrder"
+PARAMS = {"pair": "XXBTZEUR", "type": "buy", "ordertype": "limit",
+          "price": "612.3", "volume": "1.25"}
+
+
+class BenchKeyHandler(KrakenKeyHandler):
+    def _loadKeys(self):
+        self.filename = None
+        self.addKey(KEY, SECRET, 1)
+
+
+def legacyAuthRequest(handler, key, url, params):
+    secret = handler.getSecret(key)
+    params = dict(params)
+    params['nonce'] = handler.getNextNonce(key)
+    message = url + hashlib.sha256(str(params['nonce']) +
+                                   urllib.urlencode(params)).digest()
+    signature = hmac.new(base64.b64decode(secret), message, hashlib.sha512)
+    header = {'API-Key': key,
+              'API-Sign': base64.b64encode(signature.digest())}
+    # the connection encoded the parameters a second time
+    return header, urllib.urlencode(params)
+
+
+def measure(label, func, count):
+    start = time.time()
+    func(count)
+    elapsed = time.time() - start
+    print("%-28s %9.0f signatures/s" % (label, count / elapsed))
+
+
+def main(count):
+    handler = BenchKeyHandler(resaveOnDeletion=True)
+
+    def legacy(n):
+        for _ in xrange(n):
+            legacyAuthRequest(handler, KEY, URL, PARAMS)
+
+    def single(n):
+        for _ in xrange(n):
+            handler.authRequest(KEY, URL, PARAMS)
+
+    def batch(n):
+        handler.signBatch(KEY, URL, [PARAMS] * n)
+
+    measure("hmac.new per request", legacy, count)
+    measure("authRequest", single, count)
+    measure("signBatch", batch, count)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+'''
+Local stand-in for the Kraken REST API, for offline benchmarks.
+
+Public endpoints answer with recorded response bodies: files named
+<Command>.json in a responses directory if given, otherwise deterministic
+synthetic bodies shaped like Kraken's.  Private endpoints check the
+API-Key, the API-Sign signature and that nonces increase per key, and
+answer with Kraken's error envelope when a check fails.  Run from the
+repository root:
+
+    python benchmarks/standin.py [--port 8080] [--responses DIR]
+                                 [--certfile PEM]
+    python benchmarks/standin.py --record DIR
+
+The second form records live public responses into DIR (needs network).
+'''
+
+from __future__ import print_function
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import ssl
+import sys
+import threading
+import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "kraken"), ROOT]
+
+
+KEY = "benchmark-key"
+SECRET = base64.b64encode("s" * 64)
+PAIR = "XXBTZEUR"
+PAIRS = ("XXBTZEUR", "XXBTZUSD", "XETHZEUR", "XETHXXBT", "XLTCZEUR")
+PUBLIC = ("Time", "Ticker", "Depth", "Trades", "OHLC", "Spread")
+# parameters used when recording, matching what the benchmarks request
+RECORD_PARAMS = {
+    "Ticker": {"pair": ",".join(PAIRS)},
+    "Depth": {"pair": PAIR, "count": 100},
+    "Trades": {"pair": PAIR},
+    "OHLC": {"pair": PAIR},
+    "Spread": {"pair": PAIR},
+}
+
+
+def envelope(result, errors=()):
+    return json.dumps({"error": list(errors), "result": result})
+
+
+def synthesize(seed=1):
+    """
+    Public response bodies shaped like Kraken's, from a fixed seed.
+    """
+    rnd = random.Random(seed)
+    t0 = 1475000000
+
+    def price(base):
+        return "%.5f" % (base * (1 + rnd.uniform(-0.01, 0.01)))
+
+    def volume():
+        return "%.8f" % rnd.uniform(0.001, 5)
+
+    ticker = {}
+    for pair in PAIRS:
+        ticker[pair] = {"a": [price(600), "1", "1.000"],
+                        "b": [price(600), "2", "2.000"],
+                        "c": [price(600), volume()],
+                        "v": [volume(), volume()],
+                        "p": [price(600), price(600)],
+                        "t": [rnd.randint(100, 5000), rnd.randint(5000, 9000)],
+                        "l": [price(590), price(580)],
+                        "h": [price(610), price(620)],
+                        "o": price(600)}
+
+    depth = {PAIR: {"asks": [[price(600 + i * 0.1), volume(), t0 + i]
+                             for i in xrange(100)],
+                    "bids": [[price(600 - i * 0.1), volume(), t0 + i]
+                             for i in xrange(100)]}}
+
+    trades = {PAIR: [[price(600), volume(), t0 + i * 0.731,
+                      rnd.choice("bs"), rnd.choice("lm"), ""]
+                     for i in xrange(1000)],
+              "last": str((t0 + 731) * 10 ** 9)}
+
+    ohlc = {PAIR: [[t0 + i * 60, price(600), price(605), price(595),
+                    price(600), price(600), volume(), rnd.randint(1, 50)]
+                   for i in xrange(720)],
+            "last": t0 + 719 * 60}
+
+    spread = {PAIR: [[t0 + i, price(599), price(601)] for i in xrange(200)],
+              "last": t0 + 199}
+
+    return {"Time": envelope({"unixtime": t0, "rfc1123": ""}),
+            "Ticker": envelope(ticker),
+            "Depth": envelope(depth),
+            "Trades": envelope(trades),
+            "OHLC": envelope(ohlc),
+            "Spread": envelope(spread)}
+
+
+PRIVATE = {
+    "Balance": envelope({"ZEUR": "1520.3190", "XXBT": "2.5000000000"}),
+    "TradeBalance": envelope({"eb": "3050.1", "tb": "3050.1", "m": "0.0",
+                              "n": "0.0", "c": "0.0", "v": "0.0",
+                              "e": "3050.1", "mf": "3050.1"}),
+    "OpenOrders": envelope({"open": {}}),
+    "ClosedOrders": envelope({"closed": {}, "count": 0}),
+    "AddOrder": envelope({"descr": {"order": "buy 1.25 XBTEUR @ limit 612.3"},
+                          "txid": ["OUF4EM-FRGI2-MQMWZD"]}),
+    "CancelOrder": envelope({"count": 1}),
+}
+
+
+def loadResponses(directory=None):
+    """
+    Synthetic public bodies, overridden by the recordings in
+    ``directory``.
+    """
+    responses = synthesize()
+    if directory is not None:
+        for name in os.listdir(directory):
+            command, ext = os.path.splitext(name)
+            if ext == ".json":
+                with open(os.path.join(directory, name), 'rb') as f:
+                    responses[command] = f.read()
+    return responses
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive, as the real API
+    protocol_version = "HTTP/1.1"
+    # one send per response and no Nagle; small writes waiting for the
+    # client's delayed ACK add 40ms to a request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        # cookie fetch of connection.Connection.getCookie
+        self._reply(200, "")
+
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        parts = self.path.split("/")
+        if len(parts) != 4 or parts[1] != "0":
+            return self._reply(404, "")
+
+        server = self.server
+        if parts[2] == "public":
+            response = server.responses.get(parts[3])
+            if response is None:
+                response = envelope(None, ["EGeneral:Unknown method"])
+            return self._reply(200, response)
+
+        if parts[2] == "private":
+            error = server.check(self.path, self.headers, body)
+            if error is not None:
+                return self._reply(200, envelope(None, [error]))
+            response = PRIVATE.get(parts[3])
+            if response is None:
+                response = envelope(None, ["EGeneral:Unknown method"])
+            return self._reply(200, response)
+
+        self._reply(404, "")
+
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Threaded stand-in server; ``port`` 0 picks a free port, see
+    server_address.  ``nonce_window`` mirrors the nonce window setting of
+    a Kraken key: a nonce up to that far below the highest one seen is
+    accepted once.  It defaults to 0 like Kraken, so every private nonce
+    has to be higher than all before it.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, responses=None, keys=None, certfile=None,
+                 nonce_window=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port),
+                                           Handler)
+        if certfile is not None:
+            self.socket = ssl.wrap_socket(self.socket, certfile=certfile,
+                                          server_side=True)
+        self.responses = loadResponses() if responses is None else responses
+        self.secrets = dict((key, base64.b64decode(secret)) for key, secret
+                            in (keys or {KEY: SECRET}).iteritems())
+        self.nonce_window = nonce_window
+        # [highest nonce, recent nonces] per key
+        self.nonces = {}
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+
+    def check(self, path, headers, body):
+        """
+        Kraken's checks of a private request; returns the error string or
+        None.
+        """
+        secret = self.secrets.get(headers.get("API-Key"))
+        if secret is None:
+            return self._reject("EAPI:Invalid key")
+
+        nonce = urlparse.parse_qs(body).get("nonce", [""])[0]
+        message = path + hashlib.sha256(nonce + body).digest()
+        expected = base64.b64encode(hmac.new(secret, message,
+                                             hashlib.sha512).digest())
+        if headers.get("API-Sign") != expected:
+            return self._reject("EAPI:Invalid signature")
+
+        key = headers.get("API-Key")
+        with self._lock:
+            highest, seen = self.nonces.setdefault(key, [0, set()])
+            if (not nonce.isdigit() or int(nonce) in seen or
+                    int(nonce) <= highest - self.nonce_window):
+                self.rejected += 1
+                return "EAPI:Invalid nonce"
+            nonce = int(nonce)
+            seen.add(nonce)
+            if nonce > highest:
+                self.nonces[key][0] = nonce
+                if len(seen) > 2 * self.nonce_window:
+                    seen.difference_update([n for n in seen if
+                                            n <= nonce - self.nonce_window])
+        return None
+
+
+    def _reject(self, error):
+        with self._lock:
+            self.rejected += 1
+        return error
+
+
+def record(directory):
+    """
+    Stores live public responses of api.kraken.com in ``directory``.
+    """
+    from connection import Connection
+    from kraken import KrakenExchange
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    connection = Connection(KrakenExchange)
+    for command in PUBLIC:
+        body = connection.makeRequest("/0/public/" + command,
+                                      RECORD_PARAMS.get(command, {}))
+        with open(os.path.join(directory, command + ".json"), 'wb') as f:
+            f.write(body)
+        print("recorded %s (%d bytes)" % (command, len(body)))
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--responses", help="directory of recorded bodies")
+    parser.add_argument("--certfile", help="PEM with key and certificate, "
+                                           "serves HTTPS")
+    parser.add_argument("--record", metavar="DIR",
+                        help="record live public responses into DIR")
+    args = parser.parse_args()
+
+    if args.record:
+        return record(args.record)
+
+    server = StandinServer(args.port, loadResponses(args.responses),
+                           certfile=args.certfile)
+    print("serving on %s:%d" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from collections import OrderedDict
+
+import threading
+import time
+
+
+FRESH = "fresh"
+STALE = "stale"
+
+
+class ResponseCache(object):
+    '''
+    Bounded LRU cache of raw public response bodies keyed on
+    (command, params).
+
+    Each command has a time to live in ``ttls``; commands without one are
+    never cached unless ``default_ttl`` is set.  Commands listed in
+    ``stale`` may be served for that many extra seconds after expiring
+    while a single background request refreshes them.  The cache evicts the
+    least recently used bodies once it holds more than ``max_entries`` of
+    them or more than ``max_bytes`` in total.
+    '''
+
+    TTLS = {
+        "Time": 1,
+        "Ticker": 1,
+        "Depth": 1,
+        "Spread": 1,
+        "Trades": 1,
+        "OHLC": 30,
+        "Assets": 3600,
+        "AssetPairs": 3600,
+    }
+
+    STALE = {
+        "Assets": 86400,
+        "AssetPairs": 86400,
+    }
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_entries=1024,
+                 ttls=None, stale=None, default_ttl=0):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttls = dict(self.TTLS if ttls is None else ttls)
+        self.stale = dict(self.STALE if stale is None else stale)
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        # key -> (expires, body)
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+
+
+    @staticmethod
+    def key(command, params):
+        return command, tuple(sorted(params.iteritems()))
+
+
+    def ttl(self, command):
+        return self.ttls.get(command, self.default_ttl)
+
+
+    def lookup(self, command, params):
+        """
+        Returns (body, state) with state FRESH or STALE, or (None, None)
+        on a miss.
+        """
+        key = self.key(command, params)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                expires, body = entry
+                if now < expires:
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return body, FRESH
+                if now < expires + self.stale.get(command, 0):
+                    self._entries[key] = entry
+                    self.stale_hits += 1
+                    return body, STALE
+                self._bytes -= len(body)
+            self.misses += 1
+        return None, None
+
+
+    def store(self, command, params, body):
+        ttl = self.ttl(command)
+        if ttl <= 0 or len(body) > self.max_bytes:
+            return
+
+        key = self.key(command, params)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._entries[key] = (time.time() + ttl, body)
+            self._bytes += len(body)
+
+            while self._entries and (self._bytes > self.max_bytes or
+                                     len(self._entries) > self.max_entries):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+
+    def claimRefresh(self, command, params):
+        """
+        Returns True if the caller should refresh a stale entry, False if
+        another refresh for it is already running.  The caller must call
+        finishRefresh afterwards.
+        """
+        key = self.key(command, params)
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            self.refreshes += 1
+            return True
+
+
+    def finishRefresh(self, command, params):
+        with self._lock:
+            self._refreshing.discard(self.key(command, params))
+
+
+    def _refresh(self, command, params, fetch):
+        try:
+            self.store(command, params, fetch())
+        except Exception:
+            # the stale body stays in place until the window runs out
+            pass
+        finally:
+            self.finishRefresh(command, params)
+
+
+    def get(self, command, params, fetch):
+        """
+        Returns the cached body or calls ``fetch()`` for a fresh one.
+        Stale entries are returned immediately and refreshed on a daemon
+        thread.
+        """
+        if self.ttl(command) <= 0:
+            return fetch()
+
+        body, state = self.lookup(command, params)
+        if state == FRESH:
+            return body
+        if state == STALE:
+            if self.claimRefresh(command, params):
+                worker = threading.Thread(target=self._refresh,
+                                          args=(command, params, fetch))
+                worker.daemon = True
+                worker.start()
+            return body
+
+        body = fetch()
+        self.store(command, params, body)
+        return body
+
+
+    def invalidate(self, command=None):
+        """
+        Drops all entries, or only those of ``command``.
+        """
+        with self._lock:
+            for key in self._entries.keys():
+                if command is None or key[0] == command:
+                    self._bytes -= len(self._entries.pop(key)[1])
+
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "stale_hits": self.stale_hits,
+                    "misses": self.misses, "evictions": self.evictions,
+                    "refreshes": self.refreshes,
+                    "entries": len(self._entries), "bytes": self._bytes}
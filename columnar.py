@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from array import array
+
+from exchange import OHLCV, Trade
+from timestamps import fromEpoch, toDateTimes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NUMPY_TYPES = {'d': 'float64', 'l': 'int64', 'b': 'int8'}
+CONVERTERS = {'d': float, 'l': int, 'b': int}
+
+
+def column(values, typecode):
+    """
+    Builds one column from a sequence of numbers or numeric strings, as a
+    NumPy array if NumPy is installed and as an ``array.array`` otherwise.
+    """
+    if numpy is not None:
+        return numpy.array(values, dtype=NUMPY_TYPES[typecode])
+    return array(typecode, map(CONVERTERS[typecode], values))
+
+
+def concatenate(columns):
+    if numpy is not None:
+        return numpy.concatenate(columns)
+    joined = array(columns[0].typecode)
+    for c in columns:
+        joined.extend(c)
+    return joined
+
+
+class _ColumnBatch(object):
+    '''
+    Rows of one pair stored column by column.  Indexing returns a light
+    row view; slicing returns a batch sharing the columns (with NumPy) or
+    a copy of them.
+    '''
+
+    COLUMNS = ()
+    VIEW = None
+
+    def __init__(self, pair, **columns):
+        self.pair = pair
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.__class__(self.pair, **dict(
+                (name, getattr(self, name)[index]) for name in self.COLUMNS))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return self.VIEW(self, index)
+
+
+    def __iter__(self):
+        view = self.VIEW
+        for i in xrange(len(self)):
+            yield view(self, i)
+
+
+    @classmethod
+    def concatenate(cls, batches):
+        """
+        Joins batches of the same pair into one.
+        """
+        batches = list(batches)
+        return cls(batches[0].pair, **dict(
+            (name, concatenate([getattr(b, name) for b in batches]))
+            for name in cls.COLUMNS))
+
+
+    def dates(self):
+        """
+        All row times as a list of datetimes, converted in one pass.
+        """
+        return toDateTimes(self.times)
+
+
+    def nbytes(self):
+        """
+        Memory held by the columns in bytes.
+        """
+        total = 0
+        for name in self.COLUMNS:
+            c = getattr(self, name)
+            total += c.nbytes if numpy is not None else \
+                     c.itemsize * len(c)
+        return total
+
+
+class TradeView(object):
+    '''
+    Row of a TradeBatch with the attributes of exchange.Trade.  Values are
+    read from the columns on access.
+    '''
+
+    __slots__ = ("_batch", "_index")
+
+    def __init__(self, batch, index):
+        self._batch = batch
+        self._index = index
+
+    pair = property(lambda self: self._batch.pair)
+    price = property(lambda self: float(self._batch.prices[self._index]))
+    amount = property(lambda self: float(self._batch.amounts[self._index]))
+    tid = property(lambda self: int(self._batch.tids[self._index]))
+
+    @property
+    def trade_type(self):
+        return "buy" if self._batch.sides[self._index] > 0 else "sell"
+
+    @property
+    def date(self):
+        return fromEpoch(self._batch.times[self._index])
+
+    @property
+    def epoch(self):
+        return float(self._batch.times[self._index])
+
+    def toTrade(self):
+        return Trade(pair=self.pair, trade_type=self.trade_type,
+                     price=self.price, tid=self.tid, amount=self.amount,
+                     date=self.epoch)
+
+
+class TradeBatch(_ColumnBatch):
+    '''
+    Columnar batch of trades: prices, amounts and epoch times as float64,
+    sides as int8 (1 buy, -1 sell) and trade ids as int64 (0 if unknown).
+    '''
+
+    COLUMNS = ("times", "prices", "amounts", "sides", "tids")
+    VIEW = TradeView
+
+    @classmethod
+    def fromKraken(cls, pair, rows):
+        """
+        Builds a batch from the rows of Kraken's Trades endpoint,
+        [price, volume, time, buy/sell, market/limit, misc(, trade_id)].
+        """
+        if not rows:
+            return cls.empty(pair)
+
+        cols = zip(*rows)
+        if len(cols) > 6:
+            tids = cols[6]
+        else:
+            tids = (0,) * len(rows)
+        return cls(pair,
+                   times=column(cols[2], 'd'),
+                   prices=column(cols[0], 'd'),
+                   amounts=column(cols[1], 'd'),
+                   sides=column([1 if s == "b" else -1 for s in cols[3]], 'b'),
+                   tids=column(tids, 'l'))
+
+
+    @classmethod
+    def empty(cls, pair):
+        return cls(pair, times=column([], 'd'), prices=column([], 'd'),
+                   amounts=column([], 'd'), sides=column([], 'b'),
+                   tids=column([], 'l'))
+
+
+class OHLCVView(object):
+    '''
+    Row of an OHLCVFrame with the attributes of exchange.OHLCV.
+    '''
+
+    __slots__ = ("_batch", "_index")
+
+    def __init__(self, batch, index):
+        self._batch = batch
+        self._index = index
+
+    pair = property(lambda self: self._batch.pair)
+    open = property(lambda self: float(self._batch.opens[self._index]))
+    high = property(lambda self: float(self._batch.highs[self._index]))
+    low = property(lambda self: float(self._batch.lows[self._index]))
+    close = property(lambda self: float(self._batch.closes[self._index]))
+    volume = property(lambda self: float(self._batch.volumes[self._index]))
+    avg = property(lambda self: float(self._batch.vwaps[self._index]))
+    count = property(lambda self: int(self._batch.counts[self._index]))
+
+    @property
+    def date(self):
+        return fromEpoch(self._batch.times[self._index])
+
+    @property
+    def epoch(self):
+        return float(self._batch.times[self._index])
+
+    updated = date
+
+    def toOHLCV(self):
+        t = float(self._batch.times[self._index])
+        return OHLCV(pair=self.pair, open=self.open, high=self.high,
+                     low=self.low, close=self.close, volume=self.volume,
+                     avg=self.avg, updated=t, date=t)
+
+
+class OHLCVFrame(_ColumnBatch):
+    '''
+    Columnar batch of candles: epoch times, open, high, low, close, vwap and
+    volume as float64 and trade counts as int64.
+    '''
+
+    COLUMNS = ("times", "opens", "highs", "lows", "closes", "vwaps",
+               "volumes", "counts")
+    VIEW = OHLCVView
+
+    @classmethod
+    def fromKraken(cls, pair, rows):
+        """
+        Builds a frame from the rows of Kraken's OHLC endpoint,
+        [time, open, high, low, close, vwap, volume, count].
+        """
+        if not rows:
+            return cls.empty(pair)
+
+        cols = zip(*rows)
+        return cls(pair,
+                   times=column(cols[0], 'd'),
+                   opens=column(cols[1], 'd'),
+                   highs=column(cols[2], 'd'),
+                   lows=column(cols[3], 'd'),
+                   closes=column(cols[4], 'd'),
+                   vwaps=column(cols[5], 'd'),
+                   volumes=column(cols[6], 'd'),
+                   counts=column(cols[7], 'l'))
+
+
+    @classmethod
+    def empty(cls, pair):
+        return cls(pair, **dict((name, column([], 'l' if name == "counts"
+                                               else 'd'))
+                                for name in cls.COLUMNS))
@@ -8,7 +8,6 @@ import re
 import os
 
 
-decimal.getcontext().rounding = decimal.ROUND_DOWN
 exps = [decimal.Decimal("1e-%d" % i) for i in range(16)]
 
 
@@ -6,93 +6,420 @@ import urllib
 import os
 import httplib
 import re
+import threading
+import time
 
-from xcptions import APIResponseError
+from contextlib import contextmanager
+from cookiestore import CookieStore
+from email.utils import mktime_tz, parsedate_tz
+from retry import RetryPolicy
+from xcptions import APIResponseError, PoolTimeoutError
 
 HEADER_COOKIE_RE = re.compile(r'__cfduid=([a-f0-9]{46})')
 BODY_COOKIE_RE = re.compile(r'document\.cookie="a=([a-f0-9]{32});path=/;";')
+PROXY_RE = re.compile(r'http://([\w.]+):(\d+)')
+MAX_AGE_RE = re.compile(r'[Mm]ax-[Aa]ge=(\d+)')
+EXPIRES_RE = re.compile(r'[Ee]xpires=([^;]+)')
+
+# cookies of connections not given a store of their own
+COOKIES = CookieStore()
+
+
+def proxySettings():
+    """
+    (host, port) of the proxy set in HTTPS_PROXY, or None.
+    """
+    proxy = os.environ.get("HTTPS_PROXY")
+    if proxy:
+        match = PROXY_RE.search(proxy)
+        if match:
+            return match.group(1), int(match.group(2))
+    return None
+
+
+def cookieExpiry(header):
+    """
+    Epoch expiry of a Set-Cookie header from its Max-Age or Expires
+    attribute, or None.
+    """
+    match = MAX_AGE_RE.search(header)
+    if match:
+        return time.time() + int(match.group(1))
+    match = EXPIRES_RE.search(header)
+    if match:
+        parsed = parsedate_tz(match.group(1))
+        if parsed is not None:
+            return mktime_tz(parsed)
+    return None
+
+
+class ConnectionPool(object):
+    '''
+    Keeps up to ``size`` keep-alive HTTPS sockets to one domain.
+
+    A socket is checked out for exactly one request/response cycle and
+    checked back in once the body has been read, so threads never share a
+    socket.  Sockets that sat idle for longer than ``idle_timeout`` seconds
+    are closed instead of being handed out again.  ``connection_class``
+    replaces httplib.HTTPSConnection, e.g. with httplib.HTTPConnection to
+    talk to a local stand-in server.
+    '''
+
+    def __init__(self, domain, size=4, timeout=30, idle_timeout=60,
+                 connection_class=httplib.HTTPSConnection):
+        if size < 1:
+            raise ValueError("A connection pool needs at least one socket")
+
+        self.domain = domain
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connection_class = connection_class
+        self._timeout = timeout
+        self._cond = threading.Condition(threading.Lock())
+        # (last_used, conn) pairs, most recently used last
+        self._idle = []
+        self._created = 0
+        self._closed = False
+
+
+    def _newConnection(self):
+        proxy = proxySettings()
+        # unwrap functools.partial to see whether this is an HTTPS class
+        cls = getattr(self.connection_class, "func", self.connection_class)
+        if proxy and issubclass(cls, httplib.HTTPSConnection):
+            conn = self.connection_class(proxy[0], port=proxy[1],
+                                         timeout=self._timeout)
+            conn.set_tunnel(self.domain)
+            return conn
+
+        return self.connection_class(self.domain, timeout=self._timeout)
+
+
+    def _popExpired(self, now):
+        # caller holds self._cond
+        expired = []
+        while self._idle and now - self._idle[0][0] > self.idle_timeout:
+            expired.append(self._idle.pop(0)[1])
+        self._created -= len(expired)
+        return expired
+
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+    def idle(self):
+        """
+        Number of idle sockets.
+        """
+        with self._cond:
+            return len(self._idle)
+
+
+    def resize(self, size):
+        """
+        Changes the maximum number of sockets; surplus sockets in use are
+        closed when checked in.
+        """
+        if size < 1:
+            raise ValueError("A connection pool needs at least one socket")
+        with self._cond:
+            self.size = size
+            self._cond.notify_all()
+
+
+    def checkout(self, timeout=None):
+        """
+        Returns an idle socket, opens a new one while the pool is below
+        ``size``, or waits for a checkin.  Raises PoolTimeoutError if no
+        socket became available within ``timeout`` seconds (defaults to
+        the socket timeout).
+        """
+        if timeout is None:
+            timeout = self._timeout
+        deadline = time.time() + timeout
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeoutError("Connection pool for %s is closed"
+                                           % self.domain)
+
+                now = time.time()
+                for conn in self._popExpired(now):
+                    conn.close()
+                    self._cond.notify()
+
+                if self._idle:
+                    return self._idle.pop()[1]
+                if self._created < self.size:
+                    self._created += 1
+                    break
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise PoolTimeoutError("No connection to %s available "
+                                           "after %ss" % (self.domain,
+                                                          timeout))
+                self._cond.wait(remaining)
+
+        try:
+            return self._newConnection()
+        except Exception:
+            self._release()
+            raise
+
+
+    def checkin(self, conn):
+        """
+        Hands a socket back once its response has been read completely.
+        """
+        with self._cond:
+            if not self._closed and self._created <= self.size:
+                self._idle.append((time.time(), conn))
+                self._cond.notify()
+                return
+
+        conn.close()
+        self._release()
+
+
+    def discard(self, conn):
+        """
+        Closes a socket that is in an unknown state and frees its slot.
+        """
+        conn.close()
+        self._release()
+
+
+    def _release(self):
+        with self._cond:
+            self._created -= 1
+            self._cond.notify()
+
+
+    @contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        except Exception:
+            self.discard(conn)
+            raise
+        self.checkin(conn)
+
+
+    def evictIdle(self):
+        """
+        Closes all sockets that were idle for longer than ``idle_timeout``.
+        Returns the number of closed sockets.
+        """
+        with self._cond:
+            expired = self._popExpired(time.time())
+            self._cond.notify(len(expired))
+
+        for conn in expired:
+            conn.close()
+
+        return len(expired)
+
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+            self._cond.notify_all()
+
+        for _, conn in idle:
+            conn.close()
+
 
 class Connection:
-    def __init__(self, broker, timeout=30):
+    def __init__(self, broker, timeout=30, pool_size=4, idle_timeout=60,
+                 retry=None, connection_class=None, instrumentation=None,
+                 transports=None, cookies=None):
         self._timeout = timeout
+        # a transport.TransportRegistry to share pools with other
+        # connections; the pool is private without one
+        self.transports = transports
+        # optional instrumentation.Instrumentation timing every attempt
+        self.instrumentation = instrumentation
+        self._connection_class = connection_class
+        self.retry = retry or RetryPolicy()
+        self._pool_size = pool_size
+        self._idle_timeout = idle_timeout
         self.headers = broker.HEADER
         self._broker = broker
+        # cookies survive reconnects and are shared per domain
+        self.cookies = cookies if cookies is not None else COOKIES
+        self.cookie = None
+        self.pool = None
         self.setup_connection( self._broker.DOMAIN )
-        
+
 
     def setup_connection( self, domain ):
-        if ("HTTPS_PROXY" in os.environ):
-            match = re.search(r'http://([\w.]+):(\d+)',os.environ['HTTPS_PROXY'])
-            if match:
-                self.conn = httplib.HTTPSConnection(match.group(1),
-                                                port=match.group(2),
-                                                timeout=self._timeout)
-                self.conn.set_tunnel( domain )
+        if self.pool is not None:
+            self.close()
+
+        if self.transports is not None:
+            self.pool = self.transports.acquire(
+                domain, size=self._pool_size, timeout=self._timeout,
+                idle_timeout=self._idle_timeout,
+                connection_class=self._connection_class)
         else:
-            self.conn = httplib.HTTPSConnection( domain, timeout=self._timeout )
-            
-        self.cookie = None
-        
+            self.pool = ConnectionPool(
+                domain, size=self._pool_size, timeout=self._timeout,
+                idle_timeout=self._idle_timeout,
+                connection_class=(self._connection_class or
+                                  httplib.HTTPSConnection))
+        self._released = False
+
 
     def close(self):
-        self.conn.close()
-       
-       
-    def getCookie(self):
-        self.cookie = ""
+        if self.transports is None:
+            self.pool.close()
+        elif not self._released:
+            # other connections may still use the shared pool
+            self._released = True
+            self.transports.release(self.pool)
 
-        try:
-            self.conn.request("GET", '/')
-            response = self.conn.getresponse()
-        except Exception:
-            # reset connection so it doesn't stay in a weird state if we catch
-            # the error in some other place
-            self.conn.close()
-            self.setup_connection()
-            raise
 
-        setCookieHeader = response.getheader("Set-Cookie")
+    def fetchCookie(self):
+        """
+        Requests new Cloudflare cookies.  Returns (cookie, expires) with the
+        earliest expiry the server named, or None if it named none.
+        """
+        cookie = ""
+        expires = None
+
+        with self.pool.connection() as conn:
+            conn.request("GET", '/')
+            response = conn.getresponse()
+            body = response.read()
+
+        setCookieHeader = response.getheader("Set-Cookie") or ""
         match = HEADER_COOKIE_RE.search(setCookieHeader)
         if match:
-            self.cookie = "__cfduid=" + match.group(1)
+            cookie = "__cfduid=" + match.group(1)
+            expires = cookieExpiry(setCookieHeader)
 
-        match = BODY_COOKIE_RE.search(response.read())
+        match = BODY_COOKIE_RE.search(body)
         if match:
-            if self.cookie != "":
-                self.cookie += '; '
-            self.cookie += "a=" + match.group(1)
-
-   
-    def makeRequest(self, url, params={}, extra_headers=None, 
-                    with_cookie=False):
-                        
-                               
-        data = urllib.urlencode(params)
-        if with_cookie:
-            if self.cookie is None:
-                self.getCookie()
+            if cookie != "":
+                cookie += '; '
+            cookie += "a=" + match.group(1)
+
+        return cookie, expires
+
+
+    def getCookie(self):
+        self.cookie = self.cookies.get(self.pool.domain, self.fetchCookie)
+        return self.cookie
+
 
-            self.headers.update({"Cookie": self.cookie})
+    def makeRequest(self, url, params={}, extra_headers=None,
+                    with_cookie=False, idempotent=None, retry=None,
+                    deadline=None):
+        """
+        POSTs ``params`` to ``url`` and returns the response body.
+
+        Failed attempts are repeated according to the ``retry`` policy
+        (the connection's policy by default) within ``deadline`` seconds.
+        Requests with extra headers are signed private calls and count as
+        not idempotent unless stated otherwise, so they are only repeated
+        if they never left this process.
+        """
+        if idempotent is None:
+            idempotent = extra_headers is None
+        policy = retry or self.retry
+
+        # signed private requests arrive already encoded
+        if isinstance(params, basestring):
+            data = params
+        else:
+            data = urllib.urlencode(params)
+        # the class-wide HEADER must never pick up per-request headers
+        headers = dict(self.headers)
+        if with_cookie:
+            headers.update({"Cookie": self.getCookie()})
 
         # PRIVAT request
         if extra_headers is not None:
-            self.headers.update(extra_headers)
-            
-        try:
-            self.conn.request("POST", url, data, self.headers)
-            response = self.conn.getresponse()
-            
-            if response.status < 200 or response.status > 299:
-                msg = "API response error: %s".format(response.status)
-                
-                raise APIResponseError(msg)
-            
-        except Exception:
-            # reset connection so it doesn't stay in a weird state if we catch
-            # the error in some other place
-            self.conn.close()
-            self.setup_connection( self._broker.DOMAIN )
-            return self.makeRequest( url, params, extra_headers, with_cookie )
-            raise
+            headers.update(extra_headers)
+
+        started = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            sent = False
+            timeout = self._timeout
+            left = policy.remaining(started, deadline)
+            if left is not None:
+                timeout = max(min(timeout, left), 0.001)
+
+            try:
+                conn = self.pool.checkout(timeout)
+            except PoolTimeoutError as e:
+                wait = policy.nextDelay(e, attempt, idempotent, sent,
+                                        started, deadline)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+                continue
+
+            timing = None
+            if self.instrumentation is not None:
+                timing = self.instrumentation.begin(url, attempt)
+                timing.bytes_out = len(data)
+
+            try:
+                if conn.sock is None:
+                    conn.timeout = timeout
+                    conn.connect()
+                    if timing is not None:
+                        timing.reconnected = True
+                        timing.tunneled = conn._tunnel_host is not None
+                else:
+                    conn.sock.settimeout(timeout)
+                if timing is not None:
+                    timing.mark("connected")
+
+                sent = True
+                conn.request("POST", url, data, headers)
+                if timing is not None:
+                    timing.mark("sent")
+                response = conn.getresponse()
+                if timing is not None:
+                    timing.mark("first_byte")
+                body = response.read()
+
+            except Exception as e:
+                if timing is not None:
+                    self.instrumentation.finish(timing, error=e)
+                # drop the socket so it doesn't stay in a weird state if we
+                # catch the error in some other place
+                self.pool.discard(conn)
+                wait = policy.nextDelay(e, attempt, idempotent, sent,
+                                        started, deadline)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+                continue
+
+            self.pool.checkin(conn)
+            if timing is not None:
+                timing.bytes_in = len(body)
+                self.instrumentation.finish(timing, response.status)
+
+            if 200 <= response.status <= 299:
+                return body
 
-        return response.read()
\ No newline at end of file
+            e = APIResponseError("API response error: %s" % response.status,
+                                 response.status)
+            wait = policy.nextDelay(e, attempt, idempotent, sent, started,
+                                    deadline)
+            if wait is None:
+                raise e
+            time.sleep(wait)
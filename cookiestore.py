@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from cache import FRESH, STALE
+
+import json
+import os
+import threading
+import time
+
+
+class CookieStore(object):
+    '''
+    Cloudflare cookies per domain, shared by all connections.
+
+    Each cookie is kept with its fetch and expiry times, the expiry being
+    the one the server named but at most ``lifetime`` seconds after the
+    fetch.  Within ``refresh_margin`` seconds of expiring, but not before
+    half its lifetime passed, a cookie is still handed out while a daemon
+    thread fetches its successor, so requests only wait for the cookie
+    round trip when there is no valid cookie at all.  With a ``filename``
+    the cookies are saved as JSON and shared with other processes: a
+    process missing a cookie reads the file again before fetching one.
+    '''
+
+    def __init__(self, filename=None, lifetime=3600, refresh_margin=300):
+        self.filename = filename
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        # domain -> (cookie, expires, fetched)
+        self._entries = {}
+        self._fetching = {}
+        self._refreshing = set()
+        self._load()
+
+
+    def _load(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'rt') as f:
+                entries = json.load(f)
+        except ValueError:
+            # torn or foreign file, fetch new cookies
+            return
+
+        with self._lock:
+            for domain, entry in entries.iteritems():
+                cookie, expires = entry[:2]
+                # files written without fetch times
+                fetched = entry[2] if len(entry) > 2 else \
+                          expires - self.lifetime
+                if expires > self._entries.get(domain, ("", 0))[1]:
+                    self._entries[domain] = (cookie, expires, fetched)
+
+
+    def _save(self):
+        # caller holds self._lock
+        if self.filename is None:
+            return
+        tmp = "%s.%d.tmp" % (self.filename, os.getpid())
+        with open(tmp, 'wt') as f:
+            json.dump(self._entries, f)
+        os.rename(tmp, self.filename)
+
+
+    def lookup(self, domain, now=None):
+        """
+        Returns (cookie, state) with state FRESH, STALE (about to expire)
+        or None if there is no valid cookie.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            cookie, expires, fetched = self._entries.get(domain,
+                                                         (None, 0, 0))
+        if expires <= now:
+            return None, None
+        # short-lived cookies would otherwise be stale right away and
+        # refreshed back to back
+        margin = min(self.refresh_margin, (expires - fetched) / 2.0)
+        if expires - margin <= now:
+            return cookie, STALE
+        return cookie, FRESH
+
+
+    def store(self, domain, cookie, expires=None):
+        fetched = time.time()
+        limit = fetched + self.lifetime
+        expires = limit if expires is None else min(expires, limit)
+        # keep what other processes saved meanwhile
+        self._load()
+        with self._lock:
+            self._entries[domain] = (cookie, expires, fetched)
+            self._save()
+
+
+    def invalidate(self, domain):
+        with self._lock:
+            if self._entries.pop(domain, None) is not None:
+                self._save()
+
+
+    def _refresh(self, domain, fetch):
+        try:
+            self.store(domain, *fetch())
+        except Exception:
+            # the current cookie stays valid until it expires
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(domain)
+
+
+    def get(self, domain, fetch):
+        """
+        Returns the cookie for ``domain``, calling ``fetch()`` for (cookie,
+        expires) if there is none.  Concurrent callers wait for one fetch.
+        """
+        cookie, state = self.lookup(domain)
+        if state == FRESH:
+            return cookie
+        if state == STALE:
+            with self._lock:
+                claimed = domain not in self._refreshing
+                self._refreshing.add(domain)
+            if claimed:
+                worker = threading.Thread(target=self._refresh,
+                                          args=(domain, fetch))
+                worker.daemon = True
+                worker.start()
+            return cookie
+
+        with self._lock:
+            lock = self._fetching.setdefault(domain, threading.Lock())
+        with lock:
+            # another thread or process may have fetched it meanwhile
+            self._load()
+            cookie, state = self.lookup(domain)
+            if state is None:
+                cookie, expires = fetch()
+                self.store(domain, cookie, expires)
+            return cookie
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+import decimal
+import json
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+FLOAT = "float"
+DECIMAL = "decimal"
+
+
+def _stdlibParser(body, numeric):
+    if numeric == DECIMAL:
+        return json.loads(body, parse_float=decimal.Decimal)
+    return json.loads(body)
+
+
+def _simplejsonParser(body, numeric):
+    return simplejson.loads(body, use_decimal=(numeric == DECIMAL))
+
+
+def _ujsonParser(body, numeric):
+    # ujson has no hook for float literals
+    if numeric == DECIMAL:
+        return _stdlibParser(body, numeric)
+    return ujson.loads(body)
+
+
+PARSERS = {"json": _stdlibParser}
+if simplejson is not None:
+    PARSERS["simplejson"] = _simplejsonParser
+if ujson is not None:
+    PARSERS["ujson"] = _ujsonParser
+
+
+def fastestParser():
+    """
+    Name of the fastest installed parser.
+    """
+    for name in ("ujson", "simplejson", "json"):
+        if name in PARSERS:
+            return name
+
+
+def registerParser(name, parser):
+    """
+    Adds a parser ``parser(body, numeric)`` that returns the decoded body.
+    """
+    PARSERS[name] = parser
+
+
+class Decoder(object):
+    '''
+    Turns a raw response body into Python objects in one pass.
+
+    ``numeric`` selects how JSON number literals are decoded, either FLOAT
+    or DECIMAL.  Kraken sends prices and volumes as strings, which are left
+    untouched here.
+    '''
+
+    def __init__(self, parser=None, numeric=FLOAT):
+        if parser is None:
+            parser = fastestParser()
+        if parser not in PARSERS:
+            raise ValueError("Unknown parser: %r" % parser)
+        if numeric not in (FLOAT, DECIMAL):
+            raise ValueError("Unknown numeric mode: %r" % numeric)
+
+        self.parser = parser
+        self.numeric = numeric
+
+
+    def decode(self, body, numeric=None):
+        return PARSERS[self.parser](body, numeric or self.numeric)
@@ -4,9 +4,14 @@
 
 from __future__ import print_function
 
-from abc import ABCMeta, abstractmethod
+from abc import ABCMeta, abstractmethod, abstractproperty
 from common import AbstractAttribute
+from decoder import Decoder
 from keyhandler import AbstractKeyHandler
+from keypool import KeyPool
+from quantize import PairQuantizers
+from timestamps import LazyDate, toEpoch
+from xcptions import InvalidTradeTypeException, InvalidTradeAmountException
 
 import datetime
 import decimal
@@ -25,17 +30,35 @@ class BaseExchange(object):
     MARGIN_TRADING  = AbstractAttribute("The broker's api adress.")
     LENDING         = AbstractAttribute("The broker's api adress.")
     HEADER          = {"Content-type": "application/x-www-form-urlencoded"}
+
+    _quantizers     = None
     
-    def __init__( self, key, keyhandler, ):
+    def __init__( self, key, keyhandler, decoder=None, cache=None,
+                  ratelimiter=None, singleflight=None, tickstore=None ):
         self.key = key
+        self.decoder = decoder or Decoder()
+        # optional cache.ResponseCache for public queries
+        self.cache = cache
+        # optional ratelimit.RateLimiter in front of every request
+        self.ratelimiter = ratelimiter
+        # optional singleflight.SingleFlight coalescing public queries
+        self.singleflight = singleflight
+        # optional tickstore.TickStore serving getTickHistory from disk
+        self.tickstore = tickstore
         self.keyhandler = keyhandler
         if not isinstance(self.keyhandler, AbstractKeyHandler):
             raise TypeError("The handler argument must be a"
                             " keyhandler.AbstractKeyHandler, such as"
                             " keyhandler.KeyHandler")
 
-        # We depend on the key handler for the secret
-        self.secret = self.keyhandler.getSecret( self.key )
+        # a keypool.KeyPool picks a key per private query
+        self.keypool = None
+        if isinstance(key, KeyPool):
+            self.keypool = key
+            self.key = self.secret = None
+        else:
+            # We depend on the key handler for the secret
+            self.secret = self.keyhandler.getSecret( self.key )
         self._setupConnection()
         
     @abstractmethod
@@ -47,17 +70,21 @@ class BaseExchange(object):
         
         
     @abstractmethod
-    def publicQuery(self, command, **params):
+    def publicQuery(self, command, numeric=None, priority=None, **params):
         """
-        Generates the URL and the params
+        Queries a public endpoint and returns the decoded result.
+        ``numeric`` overrides the decoder's numeric mode for this call,
+        ``priority`` the rate limiter's priority for the command.
         """
         pass
         
     
     @abstractmethod
-    def privateQuery(self, command, **params):
+    def privateQuery(self, command, numeric=None, priority=None, **params):
         """
-        Send the order to the brokerage.
+        Sends a signed request and returns the decoded result.
+        ``numeric`` overrides the decoder's numeric mode for this call,
+        ``priority`` the rate limiter's priority for the command.
         """
         pass
         
@@ -92,12 +119,74 @@ class BaseExchange(object):
         Send the order to the brokerage.
         """
         pass
+
+
+    @abstractproperty
+    def metadata(self):
+        """
+        metadata.MarketMetadata of the exchange, which validates pairs and
+        orders and compiles the quantizers.
+        """
+        pass
       
       
+    def _validatePair(self, pair):
+        """
+        Returns the canonical name of ``pair`` from the exchange metadata.
+        Raises InvalidTradePairException for unknown pairs.
+        """
+        return self.metadata.resolve(pair)
+
+
+    def _validateOrder(self, pair, trade_type, rate, amount):
+        pair = self._validatePair(pair)
+        if trade_type not in ("buy", "sell"):
+            raise InvalidTradeTypeException("Unrecognized trade type: %r" % trade_type)
+
+        minimum_amount = self.metadata.minOrder(pair)
+        if minimum_amount is not None and amount < minimum_amount:
+            formatted_min_amount = self._formatCurrency(minimum_amount, pair)
+            msg = "Trade amount %r too small; should be >= %s" % \
+                  (amount, formatted_min_amount)
+            raise InvalidTradeAmountException(msg)
+        return pair
+
+
+    @property
+    def quantizers(self):
+        """
+        quantize.PairQuantizers compiled from the exchange metadata, and
+        compiled again once the metadata was replaced, e.g. refreshed.
+        """
+        metadata = self.metadata
+        quantizers = self._quantizers
+        if quantizers is None or quantizers.metadata is not metadata:
+            quantizers = self._quantizers = PairQuantizers(metadata)
+        return quantizers
+
+
+    def _truncateAmount(self, value, pair):
+        return self.quantizers.volume(pair).truncate(value)
+
+
+    def _formatCurrency(self, value, pair):
+        return self.quantizers.volume(pair).format(value)
+
+
+    def _formatPrice(self, value, pair):
+        return self.quantizers.price(pair).format(value)
+
+
     @abstractmethod
     def getTicker(self, pair):
         """Retrieve the ticker for the given pair.  Returns a Ticker instance."""
         pass
+
+
+    def getTickers(self, pairs):
+        """Retrieve the tickers for several pairs.  Returns a dict of Ticker
+        instances keyed by pair."""
+        return dict((pair, self.getTicker(pair)) for pair in pairs)
         
 
     @abstractmethod
@@ -108,76 +197,96 @@ class BaseExchange(object):
 
 
     @abstractmethod
-    def getTradeHistory(self, pair):
+    def getTradeHistory(self, pair, since=None, until=None):
         """Retrieve the trade history for the given pair.  Returns a list of
-        Trade instances.  If count is not None, it should be an integer, and
-        specifies the number of items from the trade history that will be
-        processed and returned."""
+        Trade instances from the cursor ``since`` up to the epoch time
+        ``until`` or the most recent trade."""
         pass
     
 
     @abstractmethod
-    def getTickHistory(self, pair, start=None, stop=None):
-        """Retrieve the ticker history for the given pair.  Returns a list of
-        Ticker instances.  If count is not None, it should be an integer, and
-        specifies the number of items from the trade history that will be
-        processed and returned."""
+    def getTickHistory(self, pair, start=None, stop=None, interval=1):
+        """Retrieve the candles of ``interval`` minutes for the given pair
+        with ``start`` <= time < ``stop`` (epoch seconds).  Returns a
+        columnar.OHLCVFrame."""
         pass
 
 
-class OrderBookItem(object):
-    __slots__ = ("pair", "type", "value", "amount", "date")
+class Ticker(object):
+    STATE = ("pair", "ask", "bid", "last", "open", "high", "low",
+             "volume", "vwap", "trades", "_date")
+    __slots__ = STATE + ("_date_cache",)
+    FIELDS = ("pair", "ask", "bid", "last", "open", "high", "low",
+              "volume", "vwap", "trades", "date")
+    date = LazyDate("_date")
 
     def __init__(self, **kwargs):
-        for s in OrderBookItem.__slots__:
+        for s in Ticker.FIELDS:
             setattr(self, s, kwargs.get(s))
 
-        self.date = datetime.datetime.fromtimestamp(self.date)
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in Ticker.STATE)
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+class OrderBookItem(object):
+    STATE = ("pair", "type", "value", "amount", "_date")
+    __slots__ = STATE + ("_date_cache",)
+    FIELDS = ("pair", "type", "value", "amount", "date")
+    date = LazyDate("_date")
+
+    def __init__(self, **kwargs):
+        for s in OrderBookItem.FIELDS:
+            setattr(self, s, kwargs.get(s))
 
     def __getstate__(self):
-        return dict((k, getattr(self, k)) for k in OrderBookItem.__slots__)
+        return dict((k, getattr(self, k)) for k in OrderBookItem.STATE)
 
     def __setstate__(self, state):
         for k, v in state.items():
             setattr(self, k, v)
 
 class OHLCV(object):
-    __slots__ = ( "pair", "open", "high", "low", "close", "volume", "avg", 
-                  "updated", "date" )
+    STATE = ( "pair", "open", "high", "low", "close", "volume", "avg", 
+              "_updated", "_date" )
+    __slots__ = STATE + ("_updated_cache", "_date_cache")
+    FIELDS = ( "pair", "open", "high", "low", "close", "volume", "avg", 
+               "updated", "date" )
+    updated = LazyDate("_updated")
+    date = LazyDate("_date")
 
     def __init__(self, **kwargs):
-        for s in OHLCV.__slots__:
+        for s in OHLCV.FIELDS:
             setattr(self, s, kwargs.get(s))
 
-        self.updated = datetime.datetime.fromtimestamp(self.updated)
-        self.date = datetime.datetime.fromtimestamp(self.date)
-
     def __getstate__(self):
-        return dict((k, getattr(self, k)) for k in OHLCV.__slots__)
+        return dict((k, getattr(self, k)) for k in OHLCV.STATE)
 
     def __setstate__(self, state):
         for k, v in state.items():
             setattr(self, k, v)
 
 class Trade(object):
-    __slots__ = ("pair", "trade_type", "price", "tid", "amount", "date")
+    STATE = ("pair", "trade_type", "price", "tid", "amount", "_date")
+    __slots__ = STATE + ("_date_cache",)
+    FIELDS = ("pair", "trade_type", "price", "tid", "amount", "date")
+    date = LazyDate("_date")
 
     def __init__(self, **kwargs):
-        for s in Trade.__slots__:
+        for s in Trade.FIELDS:
             setattr(self, s, kwargs.get(s))
 
-        if type(self.date) in (int, float, decimal.Decimal):
-            self.date = datetime.datetime.fromtimestamp(self.date)
-        elif type(self.date) in (str, unicode):
-            if "." in self.date:
-                self.date = datetime.datetime.strptime(self.date,
-                                                       "%Y-%m-%d %H:%M:%S.%f")
-            else:
-                self.date = datetime.datetime.strptime(self.date,
-                                                       "%Y-%m-%d %H:%M:%S")
+    @property
+    def epoch(self):
+        """
+        Epoch seconds of the trade, without building the datetime.
+        """
+        return toEpoch(Trade.date.raw(self))
 
     def __getstate__(self):
-        return dict((k, getattr(self, k)) for k in Trade.__slots__)
+        return dict((k, getattr(self, k)) for k in Trade.STATE)
 
     def __setstate__(self, state):
         for k, v in state.items():
@@ -210,43 +319,49 @@ class TransactionHistoryItem(object):
     '''A list of instances of this class will be returned by
     a successful call to TradeAPI.transHistory.'''
     
-    __slots__ =  ("type", "amount", "currency", "desc", "status", "date")
+    __slots__ =  ("transaction_id", "type", "amount", "currency", "desc",
+                  "status", "_date", "_date_cache")
+    FIELDS = ("type", "amount", "currency", "desc", "status", "date")
+    date = LazyDate("_date")
     
     def __init__(self, transaction_id, info):
         self.transaction_id = transaction_id
         
-        for n in TransactionHistoryItem.__slots__:
+        for n in TransactionHistoryItem.FIELDS:
             setattr(self, n, info.get(n))
-        self.date = datetime.fromtimestamp(self.date)
 
 
 class TradeHistoryItem(object):
     '''A list of instances of this class will be returned by
     a successful call to TradeAPI.tradeHistory.'''
 
-    __slots__ = ("pair", "type", "amount", "rate", "order_id", "is_your_order",
-                 "date")
+    __slots__ = ("transaction_id", "pair", "type", "amount", "rate",
+                 "order_id", "is_your_order", "_date", "_date_cache")
+    FIELDS = ("pair", "type", "amount", "rate", "order_id", "is_your_order",
+              "date")
+    date = LazyDate("_date")
                  
     def __init__(self, transaction_id, info):
         self.transaction_id = transaction_id
         
-        for n in TradeHistoryItem.__slots__:
+        for n in TradeHistoryItem.FIELDS:
             setattr(self, n, info.get(n))
-        self.date = datetime.fromtimestamp(self.date)
 
 
 class OrderItem(object):
     '''A list of instances of this class will be returned by
     a successful call to TradeAPI.activeOrders.'''
     
-    __slots__ = ("pair", "type", "amount", "rate", "date", "status")
+    __slots__ = ("order_id", "pair", "type", "amount", "rate", "_date",
+                 "status", "_date_cache")
+    FIELDS = ("pair", "type", "amount", "rate", "date", "status")
+    date = LazyDate("_date")
     
     def __init__(self, order_id, info):
         self.order_id = int(order_id)
         
-        for n in OrderItem.__slots__:
+        for n in OrderItem.FIELDS:
             setattr(self, n, info.get(n))
-        self.date = datetime.fromtimestamp(self.date)
 
 
 class TradeResult(object):
@@ -271,57 +386,3 @@ class CancelOrderResult(object):
         funds = info.get(u'funds')
         for c in common.all_currencies:
             setattr(self, "balance_%s" % c, funds.get(unicode(c), 0))
-
-        
-'''
-    def _validatePair(self, pair):
-        if pair not in self.all_pairs:
-            if "_" in pair:
-                a, b = pair.split("_", 1)
-                swapped_pair = "%s_%s" % (b, a)
-                if swapped_pair in self.all_pairs:
-                    msg = "Unrecognized pair: %r (did you mean %s?)"
-                    msg = msg % (pair, swapped_pair)
-                    raise InvalidTradePairException(msg)
-            raise InvalidTradePairException("Unrecognized pair: %r" % pair)
-
-
-    def _validateOrder(pair, trade_type, rate, amount):
-        validatePair(pair)
-        if trade_type not in ("buy", "sell"):
-            raise InvalidTradeTypeException("Unrecognized trade type: %r" % trade_type)
-    
-        minimum_amount = self.min_orders[pair]
-        formatted_min_amount = formatCurrency(minimum_amount, pair)
-        if amount < minimum_amount:
-            msg = "Trade amount %r too small; should be >= %s" % \
-                  (amount, formatted_min_amount)
-            raise InvalidTradeAmountException(msg)
-    
-    
-    def _truncateAmountDigits(value, digits):
-        quantum = exps[digits]
-        if type(value) is float:
-            value = str(value)
-        if type(value) is str:
-            value = decimal.Decimal(value)
-        return value.quantize(quantum)
-    
-    
-    def _truncateAmount(value, pair):
-        return truncateAmountDigits(value, self.max_digits[pair])
-    
-    
-    def _formatCurrencyDigits(value, digits):
-        s = str(truncateAmountDigits(value, digits))
-        s = s.rstrip("0")
-        if s[-1] == ".":
-            s = "%s0" % s
-    
-        return s
-    
-    
-    def _formatCurrency(value, pair):
-        return formatCurrencyDigits(value, self.max_digits[pair])    
-    
-'''
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from bisect import bisect_left
+
+import threading
+import time
+
+
+# phases of one attempt, each measured from the end of the previous one
+PHASES = ("connect", "send", "wait", "read", "total")
+# counters kept per endpoint
+COUNTERS = ("requests", "errors", "retries", "reconnects", "tunnels",
+            "bytes_out", "bytes_in")
+
+
+class LatencyHistogram(object):
+    '''
+    Latency histogram with fixed bucket bounds in seconds.  ``counts``
+    holds the observations per bucket; prometheus() turns them into the
+    cumulative counts of the exposition format.
+    '''
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last bucket holds everything above the highest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the ``q`` quantile; None for an
+        empty histogram, infinity if it lies above the highest bound.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+    def asDict(self):
+        return {"bounds": list(self.bounds), "counts": list(self.counts),
+                "count": self.count, "sum": self.sum}
+
+
+class RequestTiming(object):
+    '''
+    Timestamps of one request attempt, handed to the hooks after every
+    phase.  Phases not reached stay None; ``ended`` is stamped when the
+    attempt finished or failed.
+    '''
+
+    __slots__ = ("url", "attempt", "started", "connected", "sent",
+                 "first_byte", "finished", "ended", "reconnected", "tunneled",
+                 "bytes_out", "bytes_in", "status", "error", "_hooks")
+
+    def __init__(self, url, attempt, hooks):
+        self.url = url
+        self.attempt = attempt
+        self.started = time.time()
+        self.connected = self.sent = self.first_byte = self.finished = None
+        self.ended = None
+        self.reconnected = self.tunneled = False
+        self.bytes_out = self.bytes_in = 0
+        self.status = self.error = None
+        self._hooks = hooks
+
+
+    def mark(self, event):
+        """
+        Stamps ``event``, one of connected, sent, first_byte or finished.
+        """
+        setattr(self, event, time.time())
+        for hook in self._hooks:
+            hook(event, self)
+
+
+    def phases(self):
+        """
+        Seconds spent per phase of PHASES that was completed.  ``total``
+        runs until the attempt ended, so a failed attempt counts with the
+        time it took to fail.
+        """
+        phases = {}
+        last = self.started
+        for phase, stamp in (("connect", self.connected),
+                             ("send", self.sent),
+                             ("wait", self.first_byte),
+                             ("read", self.finished)):
+            if stamp is None:
+                break
+            phases[phase] = stamp - last
+            last = stamp
+        phases["total"] = (self.ended if self.ended is not None
+                           else last) - self.started
+        return phases
+
+
+class Instrumentation(object):
+    '''
+    Per-endpoint latency histograms and counters for connection.Connection.
+
+    Pass an instance as ``instrumentation`` to the connection; without one
+    makeRequest does no timing at all.  Every attempt is split into the
+    phases connect (including a proxy tunnel; zero on a reused socket),
+    send, wait (until the status line arrived) and read, each recorded in
+    a histogram per endpoint, next to the counters of COUNTERS.  Hooks are
+    called as ``hook(event, timing)`` after every phase of every attempt
+    and once with event "done".  snapshot() returns everything as a
+    JSON-serializable dict, prometheus() in Prometheus' text format.
+    '''
+
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+              1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, bounds=None, hooks=None):
+        self.bounds = tuple(sorted(bounds or self.BOUNDS))
+        self.hooks = list(hooks or [])
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+
+    def begin(self, url, attempt):
+        return RequestTiming(url, attempt, self.hooks)
+
+
+    def finish(self, timing, status=None, error=None):
+        """
+        Records a finished or failed attempt.
+        """
+        timing.status = status
+        timing.error = error
+        if error is None:
+            timing.mark("finished")
+            timing.ended = timing.finished
+        else:
+            timing.ended = time.time()
+
+        phases = timing.phases()
+        with self._lock:
+            histograms = self._histograms.get(timing.url)
+            if histograms is None:
+                histograms = self._histograms[timing.url] = dict(
+                    (phase, LatencyHistogram(self.bounds))
+                    for phase in PHASES)
+                self._counters[timing.url] = dict.fromkeys(COUNTERS, 0)
+            for phase, seconds in phases.iteritems():
+                histograms[phase].observe(seconds)
+
+            counters = self._counters[timing.url]
+            counters["requests"] += 1
+            counters["errors"] += error is not None or not (
+                status is not None and 200 <= status <= 299)
+            counters["retries"] += timing.attempt > 1
+            counters["reconnects"] += timing.reconnected
+            counters["tunnels"] += timing.tunneled
+            counters["bytes_out"] += timing.bytes_out
+            counters["bytes_in"] += timing.bytes_in
+
+        for hook in self.hooks:
+            hook("done", timing)
+
+
+    def snapshot(self):
+        """
+        Counters and histograms per endpoint.
+        """
+        with self._lock:
+            return dict((url, {"counters": dict(self._counters[url]),
+                               "latency": dict(
+                                   (phase, h.asDict())
+                                   for phase, h in histograms.iteritems())})
+                        for url, histograms in self._histograms.iteritems())
+
+
+    def percentiles(self, q=(0.5, 0.99), phase="total"):
+        """
+        Bucket bounds of the quantiles ``q`` of ``phase`` per endpoint.
+        """
+        with self._lock:
+            return dict((url, [histograms[phase].percentile(x) for x in q])
+                        for url, histograms in self._histograms.iteritems())
+
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+    def prometheus(self, prefix="pyxchange"):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = ["# TYPE %s_request_seconds histogram" % prefix]
+        for url, data in sorted(snapshot.iteritems()):
+            for phase, h in sorted(data["latency"].iteritems()):
+                labels = 'endpoint="%s",phase="%s"' % (url, phase)
+                cumulative = 0
+                for bound, n in zip(h["bounds"] + ["+Inf"], h["counts"]):
+                    cumulative += n
+                    lines.append('%s_request_seconds_bucket{%s,le="%s"} %d'
+                                 % (prefix, labels, bound, cumulative))
+                lines.append("%s_request_seconds_sum{%s} %f"
+                             % (prefix, labels, h["sum"]))
+                lines.append("%s_request_seconds_count{%s} %d"
+                             % (prefix, labels, h["count"]))
+
+        for counter in COUNTERS:
+            lines.append("# TYPE %s_%s_total counter" % (prefix, counter))
+            for url, data in sorted(snapshot.iteritems()):
+                lines.append('%s_%s_total{endpoint="%s"} %d'
+                             % (prefix, counter, url,
+                                data["counters"][counter]))
+        return "\n".join(lines) + "\n"
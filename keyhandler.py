@@ -3,13 +3,14 @@
 
 from abc import ABCMeta, abstractmethod
 from xcptions import InvalidNonceException
-import inspect, os
+import inspect, os, threading, warnings
 
 
 class KeyData(object):
     def __init__(self, secret, nonce):
         self.secret = secret
         self.nonce = nonce
+        self._lock = threading.Lock()
 
     # BTC-e's API caps nonces' values
     MAX_NONCE_VALUE = 42949672940000000
@@ -17,34 +18,82 @@ class KeyData(object):
     def setNonce(self, newNonce):
         if newNonce <= 0:
             raise InvalidNonceException('Nonces must be positive')
-        if newNonce <= self.nonce:
-            raise InvalidNonceException('Nonces must be strictly increasing')
         if newNonce > self.MAX_NONCE_VALUE:
             raise InvalidNonceException('Nonces cannot be greater than %d' %
                                         self.MAX_NONCE_VALUE)
+        with self._lock:
+            if newNonce <= self.nonce:
+                raise InvalidNonceException('Nonces must be strictly '
+                                            'increasing', self.nonce, newNonce)
 
-        self.nonce = newNonce
+            self.nonce = newNonce
 
-        return self.nonce
+            return self.nonce
 
     def incrementNonce(self):
-        if self.nonce >= self.MAX_NONCE_VALUE:
-            raise InvalidNonceException('Cannot increment nonce, already at'
-                                        ' maximum value')
+        return self.reserveNonces(1)[1]
 
-        self.nonce += 1
+    def reserveNonces(self, count):
+        """
+        Atomically reserves ``count`` consecutive nonces and returns the
+        first and the last of them.
+        """
+        with self._lock:
+            if self.nonce + count > self.MAX_NONCE_VALUE:
+                raise InvalidNonceException('Cannot increment nonce, already '
+                                            'at maximum value')
 
-        return self.nonce
+            first = self.nonce + 1
+            self.nonce += count
+
+            return first, self.nonce
+
+
+class NonceTicket(object):
+    '''Holds a key's send lock from nonce generation until the response
+    has been read.  release() may be called more than once.'''
+
+    __slots__ = ("_lock",)
+
+    def __init__(self, lock=None):
+        self._lock = lock
+        if lock is not None:
+            lock.acquire()
+
+    def release(self):
+        lock, self._lock = self._lock, None
+        if lock is not None:
+            lock.release()
 
 
 class AbstractKeyHandler(object):
     '''AbstractKeyHandler handles the tedious task of managing nonces
     associated with BTC-e API key/secret pairs.
-    The getNextNonce method is threadsafe, all others need not be.'''
+    The getNextNonce and sequence methods are threadsafe, all others need
+    not be.
+
+    With nonceBlock > 1 every thread reserves that many nonces per key at
+    once and hands them out without touching the shared counter.  A thread
+    whose block fell more than nonceBlock behind the key's counter, e.g.
+    after idling while others kept reserving, drops the rest of it and
+    reserves a new one, so a nonce is handed out at most 2 * nonceBlock
+    below the counter.  Nonces of different threads then reach the server
+    out of order by about nonceBlock * (threads + 1), as long as every
+    request is sent before the others reserved more than a block each; the
+    key's nonce window must cover that.
+    With the default of 1 nonces are strictly increasing at the server as
+    long as callers hold sequence() until the response has been read.
+    Releasing it once the request was written is not enough: requests
+    sent in order over several pooled sockets may still be handled out of
+    order.
+
+    An optional noncejournal.NonceJournal durably records leased high-water
+    marks, so a restarted process resumes above every nonce it may have
+    used even if key_file was never rewritten.'''
     
     __metaclass__   = ABCMeta
     
-    def __init__(self, resaveOnDeletion=True):
+    def __init__(self, resaveOnDeletion=True, nonceBlock=1, journal=None):
         '''The given file is assumed to be a text file with three lines
         (key, secret, nonce) per entry.'''
         if not resaveOnDeletion:
@@ -52,6 +101,10 @@ class AbstractKeyHandler(object):
                           " default to True in future versions.")
                          
         self.resaveOnDeletion = resaveOnDeletion
+        self.nonceBlock = nonceBlock
+        self._blocks = threading.local()
+        self._sendLocks = {}
+        self.journal = journal
         
         _curfname = inspect.getfile(self.__class__)
         _fpath = os.path.dirname(os.path.abspath(_curfname))
@@ -101,6 +154,8 @@ class AbstractKeyHandler(object):
 
     def close(self):
         self._updateDatastore()
+        if self.journal is not None:
+            self.journal.close()
 
     def __enter__(self):
         return self
@@ -109,11 +164,44 @@ class AbstractKeyHandler(object):
         self.close()
 
     def addKey(self, key, secret, next_nonce):
+        if self.journal is not None:
+            next_nonce = max(next_nonce, self.journal.marks.get(key, 0))
         self._keys[key] = KeyData(secret, next_nonce)
         return self
 
     def getNextNonce(self, key):
-        return self.getKey(key).incrementNonce()
+        if self.nonceBlock <= 1:
+            nonce = self.getKey(key).incrementNonce()
+            self._lease(key, nonce)
+            return nonce
+
+        blocks = getattr(self._blocks, 'keys', None)
+        if blocks is None:
+            blocks = self._blocks.keys = {}
+        data = self.getKey(key)
+        block = blocks.get(key)
+        # a used up block, or one left behind by the other threads
+        if (block is None or block[0] > block[1] or
+                data.nonce - block[1] > self.nonceBlock):
+            block = blocks[key] = list(data.reserveNonces(self.nonceBlock))
+            self._lease(key, block[1])
+        nonce = block[0]
+        block[0] += 1
+        return nonce
+
+    def _lease(self, key, nonce):
+        journal = self.journal
+        if journal is not None and not journal.covers(key, nonce):
+            journal.extend(key, nonce)
+
+    def sequence(self, key):
+        '''Returns a NonceTicket that serializes nonce generation and sending
+        for ``key``.  Release it once the response has been read, which
+        leaves one private request per key in flight.  In block mode the
+        ticket is a no-op.'''
+        if self.nonceBlock > 1:
+            return NonceTicket()
+        return NonceTicket(self._sendLocks.setdefault(key, threading.Lock()))
 
     def getSecret(self, key):
         return self.getKey(key).secret
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from contextlib import contextmanager
+from xcptions import KeyPoolError
+
+import math
+import threading
+import time
+
+
+class KeyPool(object):
+    '''
+    Spreads the private queries of an exchange over several API keys of
+    one key handler.
+
+    Each query goes to the key with the fewest requests in flight among
+    those holding the required permission; ties go to the key with the
+    lowest recent load, a request count decaying with ``half_life``
+    seconds.  ``permissions`` maps keys to the set of permission names
+    they were created with; keys without an entry may do everything.
+    Nonces stay per key, so every key keeps its own sequence.
+    '''
+
+    def __init__(self, keyhandler, keys=None, permissions=None,
+                 half_life=60.0):
+        self.keyhandler = keyhandler
+        self.keys = list(keys if keys is not None else keyhandler.keys)
+        if not self.keys:
+            raise KeyPoolError("A key pool needs at least one key")
+        for key in self.keys:
+            keyhandler.getKey(key)
+
+        self.permissions = dict(permissions or {})
+        self._decay = math.log(2) / half_life
+        self._lock = threading.Lock()
+        self._in_flight = dict((key, 0) for key in self.keys)
+        self._requests = dict((key, 0) for key in self.keys)
+        self._load = dict((key, 0.0) for key in self.keys)
+        self._stamp = dict((key, time.time()) for key in self.keys)
+
+
+    def allows(self, key, permission):
+        allowed = self.permissions.get(key)
+        return permission is None or allowed is None or permission in allowed
+
+
+    def _decayed(self, key, now):
+        return self._load[key] * math.exp(-self._decay * (now - self._stamp[key]))
+
+
+    def acquire(self, permission=None):
+        """
+        Picks the least loaded key allowed to use ``permission`` and counts
+        a request on it.  Pair every call with release(key).
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [key for key in self.keys
+                          if self.allows(key, permission)]
+            if not candidates:
+                raise KeyPoolError("No key with permission %r" % permission)
+
+            key = min(candidates, key=lambda k: (self._in_flight[k],
+                                                 self._decayed(k, now)))
+            self._load[key] = self._decayed(key, now) + 1
+            self._stamp[key] = now
+            self._in_flight[key] += 1
+            self._requests[key] += 1
+            return key
+
+
+    def release(self, key):
+        with self._lock:
+            self._in_flight[key] -= 1
+
+
+    @contextmanager
+    def use(self, permission=None):
+        key = self.acquire(permission)
+        try:
+            yield key
+        finally:
+            self.release(key)
+
+
+    def utilization(self):
+        """
+        Per key: requests in flight, total requests, the decayed recent
+        load and the key's share of all requests so far.
+        """
+        now = time.time()
+        with self._lock:
+            total = float(sum(self._requests.itervalues())) or 1.0
+            return dict((key, {"in_flight": self._in_flight[key],
+                               "requests": self._requests[key],
+                               "load": self._decayed(key, now),
+                               "share": self._requests[key] / total})
+                        for key in self.keys)
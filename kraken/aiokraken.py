@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+from aioconnection import AsyncConnection
+from cache import STALE
+from columnar import OHLCVFrame, TradeBatch
+from kraken import (KrakenExchange, orderBookFrom, pageRows, searchSorted,
+                    tickersFrom)
+from metadata import MarketMetadata
+
+import time
+
+import trollius as asyncio
+from trollius import From, Return
+
+
+class AsyncKrakenExchange(KrakenExchange):
+    '''
+    Kraken Exchange on an asyncio event loop.
+
+    publicQuery and privateQuery are coroutines, so one loop can keep many
+    requests in flight over the pooled streams of an AsyncConnection.
+    Private calls for the same key are serialized from nonce generation
+    until their response arrived, so Kraken handles the nonces in the
+    order they were issued; calls for different keys (see keypool.KeyPool)
+    and public calls run concurrently.
+    The blocking ratelimit.RateLimiter is not consulted here; ``priority``
+    is accepted for signature compatibility only.
+
+    The query helpers of KrakenExchange (getTicker, getOrderBook,
+    getTradeHistory, ...) are coroutines here too and share its parsing.
+    metadata is read from METADATA_FILE when fresh, otherwise run the
+    coroutine loadMetadata() before using it, e.g. for order validation.
+    The page iterators and backfills of KrakenExchange block on threads
+    and are not available.  The streams belong to the event loop, so they
+    are not pooled in transport.TRANSPORTS; the loop's connection only
+    shares its SSLContext.
+    '''
+
+    def __init__(self, key, keyhandler, loop=None, pool_size=100,
+                 decoder=None, cache=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._pool_size = pool_size
+        self._nonce_locks = {}
+        self._series_locks = {}
+        super(AsyncKrakenExchange, self).__init__(key, keyhandler, decoder,
+                                                  cache)
+
+
+    def _setupConnection(self):
+        self.connection = AsyncConnection( self, pool_size=self._pool_size,
+                                           loop=self._loop )
+
+
+    def _nonceLock(self, key):
+        lock = self._nonce_locks.get(key)
+        if lock is None:
+            lock = self._nonce_locks[key] = asyncio.Lock(loop=self._loop)
+        return lock
+
+
+    def _seriesLock(self, pair, interval):
+        # the thread and file locks of a TickSeries do not exclude
+        # coroutines running on the same thread
+        lock = self._series_locks.get((pair, interval))
+        if lock is None:
+            lock = self._series_locks[(pair, interval)] = asyncio.Lock(
+                loop=self._loop)
+        return lock
+
+
+    @asyncio.coroutine
+    def publicQuery(self, command, numeric=None, priority=None, **params):
+        """
+        Generates the URL and the params
+        """
+        url = "/0/public/" + command
+        cache = self.cache
+        if cache is None or cache.ttl(command) <= 0:
+            body = yield From(self.connection.makeRequest(url, params))
+            raise Return(self._decode(body, numeric))
+
+        body, state = cache.lookup(command, params)
+        if state == STALE and cache.claimRefresh(command, params):
+            asyncio.ensure_future(self._refresh(command, url, params),
+                                  loop=self._loop)
+        elif state is None:
+            body = yield From(self.connection.makeRequest(url, params))
+            # error envelopes raise here and are never stored
+            data = self._decode(body, numeric)
+            cache.store(command, params, body)
+            raise Return(data)
+        raise Return(self._decode(body, numeric))
+
+
+    @asyncio.coroutine
+    def rawQuery(self, command, priority=None, **params):
+        """
+        Returns the undecoded body of a public query.  Bypasses the cache.
+        """
+        body = yield From(self.connection.makeRequest("/0/public/" + command,
+                                                      params))
+        raise Return(body)
+
+
+    @asyncio.coroutine
+    def _refresh(self, command, url, params):
+        try:
+            body = yield From(self.connection.makeRequest(url, params))
+            self._decode(body, None)
+            self.cache.store(command, params, body)
+        except Exception:
+            pass
+        finally:
+            self.cache.finishRefresh(command, params)
+
+
+    @asyncio.coroutine
+    def privateQuery(self, command, numeric=None, priority=None, **params):
+        """
+        Send the order to the brokerage.
+        """
+        if self.keypool is None:
+            result = yield From(self._privateQuery(self.key, command,
+                                                   numeric, params))
+            raise Return(result)
+
+        key = self.keypool.acquire(self.PERMISSIONS.get(command))
+        try:
+            result = yield From(self._privateQuery(key, command, numeric,
+                                                   params))
+        finally:
+            self.keypool.release(key)
+        raise Return(result)
+
+
+    @asyncio.coroutine
+    def _privateQuery(self, key, command, numeric, params):
+        url = "/0/private/" + command
+        lock = self._nonceLock(key)
+        # held until the response arrived: requests written in order over
+        # several streams may still be handled out of order
+        yield From(lock.acquire())
+        try:
+            headers, data = self.keyhandler.authRequest(key, url, params)
+            body = yield From(self.connection.makeRequest(url, data,
+                                                          headers))
+        finally:
+            lock.release()
+        raise Return(self._decode(body, numeric))
+
+
+    @property
+    def metadata(self):
+        """
+        metadata.MarketMetadata index, read from METADATA_FILE if it is
+        fresh.  Raises RuntimeError if neither that file nor an earlier
+        loadMetadata() provided one.
+        """
+        if self._metadata is None:
+            md = MarketMetadata.load(self.METADATA_FILE, self.METADATA_MAX_AGE)
+            if md is None:
+                raise RuntimeError("No market metadata loaded; run "
+                                   "loadMetadata() first")
+            self._metadata = md
+        return self._metadata
+
+
+    @asyncio.coroutine
+    def loadMetadata(self, refresh=False):
+        """
+        Coroutine version of KrakenExchange.loadMetadata.
+        """
+        md = None
+        if not refresh:
+            md = MarketMetadata.load(self.METADATA_FILE, self.METADATA_MAX_AGE)
+        if md is None:
+            pairs, assets = yield From(asyncio.gather(
+                self.publicQuery("AssetPairs"), self.publicQuery("Assets"),
+                loop=self._loop))
+            md = MarketMetadata(pairs, assets)
+            self._saveMetadata(md)
+        self._metadata = md
+        raise Return(md)
+
+
+    @asyncio.coroutine
+    def multiPairQuery(self, command, pairs, numeric=None, priority=None,
+                       **params):
+        """
+        Coroutine version of KrakenExchange.multiPairQuery; the chunks are
+        requested concurrently on the loop.
+        """
+        results = yield From(asyncio.gather(
+            *[self.publicQuery(command, numeric, priority, pair=chunk,
+                               **params)
+              for chunk in self._pairChunks(pairs)], loop=self._loop))
+        merged = {}
+        for result in results:
+            merged.update(result)
+        raise Return(merged)
+
+
+    @asyncio.coroutine
+    def getTickers(self, pairs):
+        now = time.time()
+        result = yield From(self.multiPairQuery("Ticker", pairs))
+        raise Return(tickersFrom(result, now))
+
+
+    @asyncio.coroutine
+    def getTicker(self, pair):
+        tickers = yield From(self.getTickers([pair]))
+        raise Return(tickers.values()[0])
+
+
+    @asyncio.coroutine
+    def _depth(self, pair, count=None):
+        result = yield From(self.publicQuery(
+            "Depth", **self._params(pair, "count", count)))
+        raise Return(result.values()[0])
+
+
+    @asyncio.coroutine
+    def getOrderBook(self, pair, count=None):
+        depth = yield From(self._depth(pair, count))
+        raise Return(orderBookFrom(depth))
+
+
+    @asyncio.coroutine
+    def updateOrderBook(self, book, count=None):
+        depth = yield From(self._depth(book.pair, count))
+        raise Return(book.applySnapshot(depth["asks"], depth["bids"]))
+
+
+    @asyncio.coroutine
+    def getTradeBatch(self, pair, since=None):
+        result = yield From(self.publicQuery(
+            "Trades", **self._params(pair, "since", since)))
+        raise Return((TradeBatch.fromKraken(pair, pageRows(result)),
+                      result["last"]))
+
+
+    @asyncio.coroutine
+    def getOHLCVFrame(self, pair, interval=1, since=None):
+        result = yield From(self.publicQuery(
+            "OHLC", **self._params(pair, "since", since, interval=interval)))
+        raise Return((OHLCVFrame.fromKraken(pair, pageRows(result)),
+                      result["last"]))
+
+
+    @asyncio.coroutine
+    def getTradeHistory(self, pair, since=None, until=None):
+        """
+        Coroutine version of KrakenExchange.getTradeHistory, fetching the
+        pages one after another like pagination.CursorPager.
+        """
+        trades = []
+        while True:
+            batch, last = yield From(self.getTradeBatch(pair, since))
+            done = not len(batch) or last == since
+            if until is not None and len(batch) and batch.times[-1] >= until:
+                batch = batch[:searchSorted(batch.times, until)]
+                done = True
+            trades.extend(view.toTrade() for view in batch)
+            if done:
+                raise Return(trades)
+            since = last
+
+
+    @asyncio.coroutine
+    def getTickHistory(self, pair, start=None, stop=None, interval=1):
+        if self.tickstore is None:
+            frame, _ = yield From(self.getOHLCVFrame(pair, interval, start))
+            raise Return(frame[searchSorted(frame.times, start or 0):
+                               searchSorted(frame.times,
+                                            stop or time.time())])
+
+        series = self.tickstore.series(pair, interval)
+        now = time.time()
+        with (yield From(self._seriesLock(pair, interval))):
+            with series.locked():
+                due, since = self._tickRefresh(series, start, stop, now)
+                if due:
+                    frame, _ = yield From(self.getOHLCVFrame(pair, interval,
+                                                             since))
+                    self._appendClosed(series, frame, now)
+        raise Return(series.range(start, stop))
+
+
+    def iterTradeHistory(self, *args, **kwargs):
+        raise NotImplementedError("Use getTradeHistory or the blocking "
+                                  "KrakenExchange")
+
+
+    def backfillTrades(self, *args, **kwargs):
+        raise NotImplementedError("Backfills need the blocking "
+                                  "KrakenExchange")
+
+
+    def backfillOHLC(self, *args, **kwargs):
+        raise NotImplementedError("Backfills need the blocking "
+                                  "KrakenExchange")
+
+
+    def close(self):
+        self.connection.close()
@@ -1,39 +1,148 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2016 Jens Lorrmann
 
+from backfill import Backfill
+from columnar import OHLCVFrame, TradeBatch
 from connection import Connection
-from exchange import BaseExchange
+from cookiestore import CookieStore
+from exchange import BaseExchange, Ticker
+from functools import partial
 from keyhandler import AbstractKeyHandler
-
-import hashlib
-import hmac
-import urllib
-import base64
+from metadata import MarketMetadata
+from pagination import CursorPager
+from ratelimit import LOW
+from signer import KrakenSigner
+from tickstore import searchSorted
+from transport import TRANSPORTS
+from xcptions import (APIError, GeneralAPIError, APIKeyError, APINonceError,
+                      RateLimitError, QueryError, OrderError, FundingError,
+                      ServiceError)
+
+import os
+import threading
 import time
 
 
+# Cloudflare cookies, shared by all processes using this file
+COOKIES = CookieStore(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'cookie_cache'))
+
+ERROR_CATEGORIES = {
+    "EGeneral": GeneralAPIError,
+    "EAPI": APIKeyError,
+    "EQuery": QueryError,
+    "EOrder": OrderError,
+    "ETrade": OrderError,
+    "EFunding": FundingError,
+    "EService": ServiceError,
+}
+
+ERROR_MESSAGES = {
+    "EAPI:Invalid nonce": APINonceError,
+    "EAPI:Rate limit exceeded": RateLimitError,
+    "EOrder:Rate limit exceeded": RateLimitError,
+}
+
+
+def raiseForErrors(errors):
+    """
+    Raises the xcptions.APIError matching the first message of Kraken's
+    ``error`` array.  Warnings (prefixed with "W") are ignored.
+    """
+    errors = [e for e in errors if not e.startswith("W")]
+    if not errors:
+        return
+
+    first = errors[0]
+    cls = ERROR_MESSAGES.get(first)
+    if cls is None:
+        cls = ERROR_CATEGORIES.get(first.split(":", 1)[0], APIError)
+    raise cls(errors)
+
+
+def parsePage(cls, decoder, pair, body):
+    """
+    Parses a raw Trades or OHLC page into ``cls``, a columnar batch class,
+    for backfill.Backfill workers.  Returns (errors, batch, last); API
+    errors come back as Kraken's messages since APIError does not survive
+    pickling.
+    """
+    data = decoder.decode(body)
+    errors = [e for e in data.get("error") or [] if not e.startswith("W")]
+    if errors:
+        return errors, None, None
+    result = data["result"]
+    return None, cls.fromKraken(pair, pageRows(result)), result.get("last")
+
+
+def pageRows(result):
+    """
+    The rows of a Trades, OHLC or Spread result, which are keyed by the
+    canonical pair name next to ``last``.
+    """
+    return [v for k, v in result.iteritems() if k != "last"][0]
+
+
+def tickersFrom(result, now):
+    """
+    Ticker instances keyed by pair from a Ticker result.
+    """
+    # high, low, volume, vwap and trades over the last 24 hours
+    return dict((pair, Ticker(pair=pair,
+                              ask=float(info["a"][0]),
+                              bid=float(info["b"][0]),
+                              last=float(info["c"][0]),
+                              open=float(info["o"]),
+                              high=float(info["h"][1]),
+                              low=float(info["l"][1]),
+                              volume=float(info["v"][1]),
+                              vwap=float(info["p"][1]),
+                              trades=int(info["t"][1]),
+                              date=now))
+                for pair, info in result.iteritems())
+
+
+def orderBookFrom(depth):
+    """
+    (asks, bids) lists of (price, volume) tuples from one pair's Depth
+    result.
+    """
+    return ([(float(l[0]), float(l[1])) for l in depth["asks"]],
+            [(float(l[0]), float(l[1])) for l in depth["bids"]])
+
+
 class KrakenKeyHandler(AbstractKeyHandler):
     '''
     Kraken KeyHandler
     '''
+
+    def __init__(self, *args, **kwargs):
+        self._signers = {}
+        super(KrakenKeyHandler, self).__init__(*args, **kwargs)
         
-    def authRequest(self, key, url, params={} ):
-        
+    def _signer(self, key):
         secret = self.getSecret( key )
-        params['nonce'] = self.getNextNonce( key )
-        
-        message = url + hashlib.sha256( str( params['nonce'] ) +
-                                            urllib.urlencode( params ) 
-                                            ).digest()
-                                           
-        signature = hmac.new( base64.b64decode( secret ), message, 
-                             hashlib.sha512 )
-        header = {
-            'API-Key': key,
-            'API-Sign': base64.b64encode( signature.digest() )
-        }
-    
-        return header, params
+        signer = self._signers.get(key)
+        if signer is None or signer.secret != secret:
+            signer = self._signers[key] = KrakenSigner(key, secret)
+        return signer
+
+    def authRequest(self, key, url, params={} ):
+        """
+        Returns (header, body) for a private request; ``body`` is the
+        urlencoded, signed request and has to be sent unchanged.
+        """
+        return self._signer(key).sign(url, self.getNextNonce( key ), params)
+
+    def signBatch(self, key, url, batch):
+        """
+        Signs several requests to ``url`` at once.  ``batch`` is a list of
+        parameter dicts; returns a list of (header, body) whose nonces
+        increase in list order.
+        """
+        signer = self._signer(key)
+        return [signer.sign(url, self.getNextNonce( key ), params)
+                for params in batch]
         
     def _resetNonce(self, key):
         self.setNextNonce(key, int(1000*time.time()))
@@ -51,80 +160,420 @@ class KrakenExchange(BaseExchange):
     HISTORICAL_DATA = True
     MARGIN_TRADING  = True
     LENDING         = False
+
+    METADATA_FILE    = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'metadata_cache')
+    METADATA_MAX_AGE = 24 * 3600
+    # longest comma separated pair list sent in one multi-pair query
+    MAX_PAIRS_LENGTH = 1500
+
+    # API key permission needed by each private command, as named on
+    # Kraken's key settings page
+    PERMISSIONS = {
+        "Balance": "query_funds",
+        "TradeBalance": "query_funds",
+        "OpenOrders": "query_open",
+        "ClosedOrders": "query_closed",
+        "QueryOrders": "query_closed",
+        "TradesHistory": "query_closed",
+        "QueryTrades": "query_closed",
+        "OpenPositions": "query_open",
+        "Ledgers": "query_ledger",
+        "QueryLedgers": "query_ledger",
+        "TradeVolume": "query_funds",
+        "AddOrder": "create_orders",
+        "CancelOrder": "cancel_orders",
+        "DepositMethods": "deposit",
+        "DepositAddresses": "deposit",
+        "DepositStatus": "deposit",
+        "WithdrawInfo": "withdraw",
+        "Withdraw": "withdraw",
+        "WithdrawStatus": "withdraw",
+        "WithdrawCancel": "withdraw",
+    }
+
+    _metadata = None
     
     def _setupConnection(self):
-        self.connection = Connection( self )
+        # all exchange objects share the sockets and cookies of
+        # api.kraken.com
+        self.connection = Connection( self, transports=TRANSPORTS,
+                                      cookies=COOKIES )
+
+
+    def close(self):
+        """
+        Hands the connection back to the shared transports.
+        """
+        self.connection.close()
     
     
-    def publicQuery(self, command, **params):
+    def _decode(self, body, numeric=None):
+        """
+        Parses the response envelope once and returns its ``result``.
+        Raises the matching xcptions.APIError if Kraken reported errors.
+        """
+        data = self.decoder.decode(body, numeric)
+        errors = data.get("error")
+        if errors:
+            raiseForErrors(errors)
+        return data.get("result")
+
+
+    def _decodeLimited(self, body, numeric, key):
+        try:
+            return self._decode(body, numeric)
+        except RateLimitError:
+            if self.ratelimiter is not None:
+                self.ratelimiter.saturate(key)
+            raise
+
+
+    def publicQuery(self, command, numeric=None, priority=None, **params):
         """
         Generates the URL and the params
         """
-        url = "/0/public/" + command
-        return self.connection.makeRequest(url, params )
+        if self.singleflight is None:
+            return self._publicQuery(command, numeric, priority, params)
+
+        # identical concurrent queries share one request and its result
+        key = (command, numeric, tuple(sorted(params.iteritems())))
+        return self.singleflight.do(key, lambda: self._publicQuery(
+            command, numeric, priority, params))
+
+
+    def rawQuery(self, command, priority=None, **params):
+        """
+        Returns the undecoded body of a public query, e.g. to parse it in
+        another process.  Bypasses the cache.
+        """
+        if self.ratelimiter is not None:
+            self.ratelimiter.acquire(command, None, priority)
+        return self.connection.makeRequest("/0/public/" + command, params)
+
+
+    def _publicQuery(self, command, numeric, priority, params):
+        fetched = []
+
+        def fetch():
+            body = self.rawQuery(command, priority, **params)
+            # raises on an error envelope, before the cache stores the body
+            fetched.append((body, self._decodeLimited(body, numeric, None)))
+            return body
+
+        if self.cache is None:
+            body = fetch()
+        else:
+            body = self.cache.get(command, params, fetch)
+        # a body fetched by this call is decoded already
+        if fetched and fetched[0][0] is body:
+            return fetched[0][1]
+        return self._decodeLimited(body, numeric, None)
     
-    def privateQuery(self, command, **params):
+
+    def privateQuery(self, command, numeric=None, priority=None, **params):
         """
         Send the order to the brokerage.
         """
+        if self.keypool is None:
+            return self._privateQuery(self.key, command, numeric, priority,
+                                      params)
+
+        with self.keypool.use(self.PERMISSIONS.get(command)) as key:
+            return self._privateQuery(key, command, numeric, priority,
+                                      params)
+
+
+    def _privateQuery(self, key, command, numeric, priority, params):
         url = "/0/private/" + command
-        headers, params = self.keyhandler.authRequest(self.key, url, params)
-        return self.connection.makeRequest(url, params, headers )
+        # wait for the rate limiter before taking the nonce lock
+        if self.ratelimiter is not None:
+            self.ratelimiter.acquire(command, key, priority)
+
+        # nonces have to be handled by Kraken in the order they were
+        # issued; with several pooled sockets only a completed response
+        # guarantees that, so one request per key is in flight
+        ticket = self.keyhandler.sequence(key)
+        try:
+            headers, data = self.keyhandler.authRequest(key, url, params)
+            body = self.connection.makeRequest(url, data, headers)
+        finally:
+            ticket.release()
+        return self._decodeLimited(body, numeric, key)
        
         
+    @property
+    def metadata(self):
+        """
+        metadata.MarketMetadata index over AssetPairs and Assets, loaded
+        on first use.
+        """
+        if self._metadata is None:
+            self.loadMetadata()
+        return self._metadata
+
+
+    def loadMetadata(self, refresh=False):
+        """
+        Loads the metadata index from METADATA_FILE if it is younger than
+        METADATA_MAX_AGE, otherwise (or with ``refresh``) from the API, and
+        writes the file for the next start.
+        """
+        md = None
+        if not refresh:
+            md = MarketMetadata.load(self.METADATA_FILE, self.METADATA_MAX_AGE)
+        if md is None:
+            md = MarketMetadata.fromExchange(self)
+            self._saveMetadata(md)
+        self._metadata = md
+        return md
+
+
+    def _saveMetadata(self, md):
+        try:
+            md.save(self.METADATA_FILE)
+        except (IOError, OSError):
+            pass
+
+
     def _pair(self):
         """
-        Send the order to the brokerage.
+        Names of all tradeable pairs.
         """
-        pass
+        return sorted(self.metadata.pairs)
         
         
     def _getfees(self):
         """
-        Send the order to the brokerage.
+        Taker fee tiers per pair as lists of (volume, percent) tuples.
         """
-        pass
+        return dict((name, zip(p.fee_volumes, p.fees))
+                    for name, p in self.metadata.pairs.iteritems())
         
         
     def _getassets(self):
         """
-        Send the order to the brokerage.
+        Asset information keyed by asset name.
         """
-        pass
+        return self.metadata.assets
         
 
     def _getminmaxorders(self):
         """
-        Send the order to the brokerage.
+        Minimum order volume per pair.
         """
-        pass
+        return dict((name, p.ordermin)
+                    for name, p in self.metadata.pairs.iteritems())
       
       
+    def multiPairQuery(self, command, pairs, numeric=None, priority=None,
+                       **params):
+        """
+        Runs a public query accepting a comma separated ``pair`` list, such
+        as Ticker or AssetPairs, for any number of pairs.  The pairs are
+        split into chunks of at most MAX_PAIRS_LENGTH characters which are
+        requested concurrently; the merged result is returned.
+        """
+        chunks = self._pairChunks(pairs)
+        results = [None] * len(chunks)
+        errors = []
+
+        def query(index):
+            try:
+                results[index] = self.publicQuery(
+                    command, numeric, priority, pair=chunks[index], **params)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=query, args=(i,))
+                   for i in xrange(1, len(chunks))]
+        for t in threads:
+            t.start()
+        if chunks:
+            query(0)
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+        merged = {}
+        for result in results:
+            merged.update(result)
+        return merged
+
+
+    def _pairChunks(self, pairs):
+        # comma separated pair lists of at most MAX_PAIRS_LENGTH characters
+        chunks, chunk, length = [], [], 0
+        for pair in pairs:
+            if chunk and length + len(pair) + 1 > self.MAX_PAIRS_LENGTH:
+                chunks.append(",".join(chunk))
+                chunk, length = [], 0
+            chunk.append(pair)
+            length += len(pair) + 1
+        if chunk:
+            chunks.append(",".join(chunk))
+        return chunks
+
+
+    def getTickers(self, pairs):
+        """Retrieve the tickers for several pairs in as few requests as
+        possible.  Returns a dict of Ticker instances keyed by Kraken's
+        pair names."""
+        now = time.time()
+        return tickersFrom(self.multiPairQuery("Ticker", pairs), now)
+
+
     def getTicker(self, pair):
         """Retrieve the ticker for the given pair.  Returns a Ticker instance."""
-        pass
+        return self.getTickers([pair]).values()[0]
         
 
-    def getOrderBook(self, pair):
-        """Retrieve the orderbook for the given pair.  Returns a tuple (asks, bids);
-        each of these is a list of (price, volume) tuples."""    
-        pass
+    @staticmethod
+    def _params(pair, name, value, **params):
+        # query params of ``pair``, with ``name`` only if ``value`` is set
+        params["pair"] = pair
+        if value is not None:
+            params[name] = value
+        return params
+
 
+    def _depth(self, pair, count=None):
+        result = self.publicQuery("Depth", **self._params(pair, "count",
+                                                          count))
+        # the result is keyed by Kraken's canonical pair name
+        return result.values()[0]
 
-    def getTradeHistory(self, pair):
+
+    def getOrderBook(self, pair, count=None):
+        """Retrieve the orderbook for the given pair.  Returns a tuple (asks, bids);
+        each of these is a list of (price, volume) tuples."""    
+        return orderBookFrom(self._depth(pair, count))
+
+
+    def updateOrderBook(self, book, count=None):
+        """Refresh an orderbook.OrderBook in place from a new snapshot.
+        Returns the number of changed price levels."""
+        depth = self._depth(book.pair, count)
+        return book.applySnapshot(depth["asks"], depth["bids"])
+
+
+    def getTradeBatch(self, pair, since=None):
+        """Retrieve one page of trades as a columnar.TradeBatch.  Returns a
+        tuple (batch, last) where ``last`` is the cursor for the next page."""
+        result = self.publicQuery("Trades", **self._params(pair, "since",
+                                                           since))
+        return TradeBatch.fromKraken(pair, pageRows(result)), result["last"]
+
+
+    def getOHLCVFrame(self, pair, interval=1, since=None):
+        """Retrieve candles of ``interval`` minutes as a columnar.OHLCVFrame.
+        Returns a tuple (frame, last) where ``last`` is the cursor for the
+        next call."""
+        result = self.publicQuery("OHLC", **self._params(
+            pair, "since", since, interval=interval))
+        return OHLCVFrame.fromKraken(pair, pageRows(result)), result["last"]
+
+
+    def iterTradeHistory(self, pair, since=None, until=None, prefetch=False):
+        """Page through the trades of ``pair`` from the cursor ``since`` on.
+        Returns a pagination.CursorPager yielding columnar.TradeBatch pages;
+        its ``last`` attribute is the cursor to resume from."""
+        return CursorPager(lambda cursor: self.getTradeBatch(pair, cursor),
+                           since, until, prefetch)
+
+
+    def _backfill(self, command, cls, pairs, since, stop, backfill, params):
+        owned = backfill is None
+        if owned:
+            backfill = Backfill()
+
+        def fetch(pair, cursor):
+            return self.rawQuery(command, LOW, **self._params(
+                pair, "since", cursor, **params))
+
+        try:
+            for pair, (errors, batch, last) in backfill.pages(
+                    pairs, fetch, partial(parsePage, cls, self.decoder),
+                    since, stop):
+                if errors:
+                    raiseForErrors(errors)
+                yield pair, batch, last
+        finally:
+            if owned:
+                backfill.close()
+
+
+    def backfillTrades(self, pairs, since=None, until=None, backfill=None):
+        """Fetch the trades of several pairs, parsing the pages in the
+        process pool of a backfill.Backfill (a new one if None).  Yields
+        (pair, TradeBatch, last) per page, in page order per pair; ``since``
+        is a cursor or a dict of cursors per pair, as recorded from
+        ``last`` to resume a backfill."""
+        stop = None
+        if until is not None:
+            stop = lambda last: int(last) >= until * 10 ** 9
+        for pair, batch, last in self._backfill("Trades", TradeBatch, pairs,
+                                                since, stop, backfill, {}):
+            if until is not None:
+                batch = batch[:searchSorted(batch.times, until)]
+            yield pair, batch, last
+
+
+    def backfillOHLC(self, pairs, interval=1, since=None, backfill=None):
+        """Fetch the candles of ``interval`` minutes of several pairs like
+        backfillTrades.  Yields (pair, OHLCVFrame, last)."""
+        return self._backfill("OHLC", OHLCVFrame, pairs, since, None,
+                              backfill, {"interval": interval})
+
+
+    def getTradeHistory(self, pair, since=None, until=None):
         """Retrieve the trade history for the given pair.  Returns a list of
-        Trade instances.  If count is not None, it should be an integer, and
-        specifies the number of items from the trade history that will be
-        processed and returned."""
-        pass
-
-
-    def getTickHistory(self, pair, start=None, stop=None):
-        """Retrieve the ticker history for the given pair.  Returns a list of
-        Ticker instances.  If count is not None, it should be an integer, and
-        specifies the number of items from the trade history that will be
-        processed and returned."""
-        pass
+        Trade instances from the cursor ``since`` up to the epoch time
+        ``until`` or the most recent trade."""
+        return [view.toTrade()
+                for batch in self.iterTradeHistory(pair, since, until)
+                for view in batch]
+
+
+    def getTickHistory(self, pair, start=None, stop=None, interval=1):
+        """Retrieve the candles of ``interval`` minutes for the given pair
+        with ``start`` <= time < ``stop`` (epoch seconds).  Returns a
+        columnar.OHLCVFrame.  With a tickstore only candles missing after
+        the last stored one are requested; Kraken serves the most recent
+        720 candles only, so earlier gaps cannot be filled."""
+        if self.tickstore is None:
+            frame = self.getOHLCVFrame(pair, interval, start)[0]
+            return frame[searchSorted(frame.times, start or 0):
+                         searchSorted(frame.times, stop or time.time())]
+
+        series = self.tickstore.series(pair, interval)
+        now = time.time()
+        # one caller fetches what is missing, the others then find it stored
+        with series.locked():
+            due, since = self._tickRefresh(series, start, stop, now)
+            if due:
+                frame = self.getOHLCVFrame(pair, interval, since)[0]
+                self._appendClosed(series, frame, now)
+        return series.range(start, stop)
+
+
+    @staticmethod
+    def _tickRefresh(series, start, stop, now):
+        # (due, since): whether candles after the last stored one closed
+        # before min(stop, now), and the cursor to fetch them from
+        end = now if stop is None else min(stop, now)
+        last = series.last()
+        # only closed candles are stored; fetch once the next one closed
+        if last is None:
+            return True, start
+        return last + 2 * series.step <= end, last
+
+
+    @staticmethod
+    def _appendClosed(series, frame, now):
+        series.append(frame[:searchSorted(frame.times, now - series.step,
+                                          right=True)])
 
 
 class OrderBookItem(object):
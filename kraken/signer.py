@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+import base64
+import hashlib
+import hmac
+import urllib
+
+
+class KrakenSigner(object):
+    '''
+    Signs private Kraken requests with one key.
+
+    The secret is base64-decoded once and kept as a pre-keyed HMAC-SHA512
+    context; every signature starts from a copy of it, which skips the key
+    padding and the two initial compression rounds of hmac.new.
+    '''
+
+    __slots__ = ("key", "secret", "_mac")
+
+    def __init__(self, key, secret):
+        self.key = key
+        self.secret = secret
+        self._mac = hmac.new(base64.b64decode(secret), digestmod=hashlib.sha512)
+
+
+    def sign(self, url, nonce, params):
+        """
+        Returns (headers, body).  ``body`` is the urlencoded request
+        including the nonce, exactly the bytes covered by the signature and
+        meant to be sent as they are.
+        """
+        params = dict(params)
+        params['nonce'] = nonce
+        body = urllib.urlencode(params)
+
+        mac = self._mac.copy()
+        mac.update(url)
+        mac.update(hashlib.sha256(str(nonce) + body).digest())
+        headers = {
+            'API-Key': self.key,
+            'API-Sign': base64.b64encode(mac.digest())
+        }
+        return headers, body
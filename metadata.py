@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from bisect import bisect_right
+
+from xcptions import InvalidTradePairException
+
+import decimal
+import json
+import os
+import time
+
+
+class PairInfo(object):
+    '''
+    Trading rules of one pair as published by the exchange.
+    '''
+
+    __slots__ = ("name", "altname", "wsname", "base", "quote",
+                 "pair_decimals", "lot_decimals", "ordermin", "fee_volumes",
+                 "fees", "fees_maker")
+
+    def __init__(self, name, info):
+        self.name = name
+        self.altname = info.get("altname")
+        self.wsname = info.get("wsname")
+        self.base = info.get("base")
+        self.quote = info.get("quote")
+        self.pair_decimals = info.get("pair_decimals")
+        self.lot_decimals = info.get("lot_decimals")
+        ordermin = info.get("ordermin")
+        self.ordermin = decimal.Decimal(str(ordermin)) if ordermin else None
+
+        fees = info.get("fees") or [[0, 0]]
+        self.fee_volumes = [tier[0] for tier in fees]
+        self.fees = [decimal.Decimal(str(tier[1])) for tier in fees]
+        maker = info.get("fees_maker") or fees
+        self.fees_maker = [decimal.Decimal(str(tier[1])) for tier in maker]
+
+
+    def fee(self, volume=0, maker=False):
+        """
+        Fee in percent for a 30 day trade ``volume``.
+        """
+        tier = max(bisect_right(self.fee_volumes, volume) - 1, 0)
+        fees = self.fees_maker if maker else self.fees
+        return fees[min(tier, len(fees) - 1)]
+
+
+class MarketMetadata(object):
+    '''
+    Index over the AssetPairs and Assets results of an exchange.
+
+    Every pair is reachable under its canonical name, its altname, its
+    wsname and "BASE_QUOTE" / "BASE/QUOTE" spelled with the asset altnames,
+    all case-insensitive, so lookups are single dict hits.  The raw results
+    are kept so the index can be written to and restored from a file.
+    '''
+
+    SEPARATORS = ("_", "/", "")
+
+    def __init__(self, pairs, assets, fetched=None):
+        self.raw_pairs = pairs
+        self.raw_assets = assets
+        self.fetched = fetched or time.time()
+
+        self.assets = assets
+        asset_alias = {}
+        for name, info in assets.iteritems():
+            asset_alias[name] = info.get("altname", name)
+
+        self.pairs = {}
+        self._aliases = {}
+        self._swapped = {}
+        for name, info in pairs.iteritems():
+            # dark pool pairs share the altname of the regular pair
+            if name.endswith(".d"):
+                continue
+            p = self.pairs[name] = PairInfo(name, info)
+            base = asset_alias.get(p.base, p.base)
+            quote = asset_alias.get(p.quote, p.quote)
+
+            for alias in (name, p.altname, p.wsname):
+                if alias:
+                    self._aliases[alias.upper()] = name
+            for sep in self.SEPARATORS:
+                self._aliases.setdefault(
+                    ("%s%s%s" % (base, sep, quote)).upper(), name)
+                self._swapped.setdefault(
+                    ("%s%s%s" % (quote, sep, base)).upper(),
+                    "%s%s%s" % (base, sep or "_", quote))
+
+
+    @classmethod
+    def fromExchange(cls, exchange):
+        return cls(exchange.publicQuery("AssetPairs"),
+                   exchange.publicQuery("Assets"))
+
+
+    def resolve(self, pair):
+        """
+        Returns the canonical name of ``pair``.  Raises
+        InvalidTradePairException, naming the swapped pair if that exists.
+        """
+        key = pair.upper()
+        name = self._aliases.get(key)
+        if name is not None:
+            return name
+
+        swapped = self._swapped.get(key)
+        if swapped is not None:
+            msg = "Unrecognized pair: %r (did you mean %s?)" % (pair, swapped)
+            raise InvalidTradePairException(msg)
+        raise InvalidTradePairException("Unrecognized pair: %r" % pair)
+
+
+    def __contains__(self, pair):
+        return pair.upper() in self._aliases
+
+
+    def pair(self, pair):
+        return self.pairs[self.resolve(pair)]
+
+
+    def minOrder(self, pair):
+        return self.pair(pair).ordermin
+
+
+    def decimals(self, pair):
+        """
+        Returns (price decimals, volume decimals) of ``pair``.
+        """
+        p = self.pair(pair)
+        return p.pair_decimals, p.lot_decimals
+
+
+    def fee(self, pair, volume=0, maker=False):
+        return self.pair(pair).fee(volume, maker)
+
+
+    def save(self, filename):
+        """
+        Writes the raw results to ``filename``, atomically replacing it.
+        """
+        tmp = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp, 'wt') as f:
+            json.dump({"fetched": self.fetched, "pairs": self.raw_pairs,
+                       "assets": self.raw_assets}, f)
+        os.rename(tmp, filename)
+
+
+    @classmethod
+    def load(cls, filename, max_age=None):
+        """
+        Restores an index written by save.  Returns None if the file is
+        missing, unreadable or older than ``max_age`` seconds.
+        """
+        try:
+            with open(filename, 'rt') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        fetched = data.get("fetched", 0)
+        if max_age is not None and time.time() - fetched > max_age:
+            return None
+        return cls(data["pairs"], data["assets"], fetched)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+import os
+import threading
+
+
+class NonceJournal(object):
+    '''
+    Append-only file recording a nonce high-water mark per key.
+
+    Nonces are leased ``lease`` at a time: before a nonce above the last
+    recorded mark is handed out, a new mark ``lease`` ahead of it is
+    appended (and fsync'ed if ``fsync`` is set).  One write therefore
+    covers ``lease`` requests, and after a crash every nonce that may have
+    been used lies at or below the last mark, so a restarted process can
+    continue right after it.  Once the file outgrows ``compact_size``
+    bytes it is rewritten atomically with only the latest mark per key.
+    '''
+
+    def __init__(self, filename, lease=1000, fsync=True,
+                 compact_size=64 * 1024):
+        self.filename = filename
+        self.lease = lease
+        self.fsync = fsync
+        self.compact_size = compact_size
+        self._lock = threading.Lock()
+        self._marks = self._read()
+        self._file = open(self.filename, 'at')
+
+
+    def _read(self):
+        marks = {}
+        if not os.path.exists(self.filename):
+            return marks
+
+        with open(self.filename, 'rt') as f:
+            for line in f:
+                # a crash may leave a torn last line behind
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 2 or not line.endswith("\n"):
+                    continue
+                try:
+                    nonce = int(parts[1])
+                except ValueError:
+                    continue
+                if nonce > marks.get(parts[0], 0):
+                    marks[parts[0]] = nonce
+        return marks
+
+
+    @property
+    def marks(self):
+        """
+        Latest high-water mark per key.
+        """
+        with self._lock:
+            return dict(self._marks)
+
+
+    def covers(self, key, nonce):
+        # unlocked fast path; marks only ever grow
+        return nonce <= self._marks.get(key, 0)
+
+
+    def extend(self, key, nonce):
+        """
+        Makes sure ``nonce`` is covered by a durable mark, writing a new one
+        ``lease`` ahead if it is not.
+        """
+        with self._lock:
+            if nonce <= self._marks.get(key, 0):
+                return
+            mark = nonce + self.lease
+            self._file.write("%s\t%d\n" % (key, mark))
+            self._sync(self._file)
+            self._marks[key] = mark
+
+            if self._file.tell() > self.compact_size:
+                self._compact()
+
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+
+    def _compact(self):
+        # caller holds self._lock
+        tmp = "%s.%d.tmp" % (self.filename, os.getpid())
+        with open(tmp, 'wt') as f:
+            for key, mark in self._marks.iteritems():
+                f.write("%s\t%d\n" % (key, mark))
+            self._sync(f)
+        os.rename(tmp, self.filename)
+
+        if self.fsync:
+            dirfd = os.open(os.path.dirname(os.path.abspath(self.filename)),
+                            os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+
+        self._file.close()
+        self._file = open(self.filename, 'at')
+
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+import time
+
+
+class BookSide(object):
+    '''
+    One side of an order book.
+
+    Price levels are kept in ascending order in two parallel ``array('d')``
+    buffers, so a side costs 16 bytes per level and no per-level objects.
+    Levels are found by binary search; inserting or removing one shifts the
+    tail of the buffers with a single memmove.  For bids the best level is
+    the last one, for asks the first one.
+    '''
+
+    __slots__ = ("prices", "volumes", "bids")
+
+    def __init__(self, bids=False):
+        self.prices = array('d')
+        self.volumes = array('d')
+        self.bids = bids
+
+
+    def __len__(self):
+        return len(self.prices)
+
+
+    def clear(self):
+        del self.prices[:]
+        del self.volumes[:]
+
+
+    def replace(self, levels):
+        """
+        Replaces all levels with ``levels``, an iterable of rows starting
+        with (price, volume) in any order and of any numeric type.
+        """
+        rows = sorted((float(l[0]), float(l[1])) for l in levels)
+        self.prices = array('d', [p for p, v in rows if v > 0])
+        self.volumes = array('d', [v for p, v in rows if v > 0])
+
+
+    def update(self, price, volume):
+        """
+        Sets the volume at ``price``; a volume of zero removes the level.
+        Returns True if the side changed.
+        """
+        price = float(price)
+        volume = float(volume)
+        prices = self.prices
+        i = bisect_left(prices, price)
+        exists = i < len(prices) and prices[i] == price
+
+        if volume <= 0:
+            if not exists:
+                return False
+            del prices[i]
+            del self.volumes[i]
+        elif exists:
+            if self.volumes[i] == volume:
+                return False
+            self.volumes[i] = volume
+        else:
+            prices.insert(i, price)
+            self.volumes.insert(i, volume)
+        return True
+
+
+    def best(self):
+        """
+        Returns the best (price, volume) or None if the side is empty.
+        """
+        if not self.prices:
+            return None
+        i = -1 if self.bids else 0
+        return self.prices[i], self.volumes[i]
+
+
+    def volumeAt(self, price):
+        price = float(price)
+        i = bisect_left(self.prices, price)
+        if i < len(self.prices) and self.prices[i] == price:
+            return self.volumes[i]
+        return 0.0
+
+
+    def _range(self, depth=None, limit=None):
+        # index range [lo, hi) of the best ``depth`` levels priced at or
+        # better than ``limit``
+        lo, hi = 0, len(self.prices)
+        if self.bids:
+            if limit is not None:
+                lo = bisect_left(self.prices, float(limit))
+            if depth is not None:
+                lo = max(lo, hi - depth)
+        else:
+            if limit is not None:
+                hi = bisect_right(self.prices, float(limit))
+            if depth is not None:
+                hi = min(hi, depth)
+        return lo, hi
+
+
+    def cumulativeVolume(self, depth=None, limit=None):
+        """
+        Total volume of the best ``depth`` levels, or of all levels priced
+        at or better than ``limit``, or of both restrictions combined.
+        """
+        lo, hi = self._range(depth, limit)
+        return sum(self.volumes[lo:hi])
+
+
+    def levels(self, depth=None):
+        """
+        Returns a fresh list of (price, volume) tuples, best level first.
+        """
+        lo, hi = self._range(depth)
+        rows = zip(self.prices[lo:hi], self.volumes[lo:hi])
+        if self.bids:
+            rows.reverse()
+        return rows
+
+
+    def applySnapshot(self, levels):
+        """
+        Brings the side in line with a newer, possibly depth-limited
+        snapshot and returns the number of changed levels.  Levels inside
+        the snapshot's price range that are missing from it are removed,
+        levels beyond its deepest price are dropped.
+        """
+        rows = dict((float(l[0]), float(l[1])) for l in levels)
+        if not rows:
+            changed = len(self.prices)
+            self.clear()
+            return changed
+
+        worst = min(rows) if self.bids else max(rows)
+        lo, hi = self._range(limit=worst)
+        if self.bids:
+            changed = lo
+            del self.prices[:lo]
+            del self.volumes[:lo]
+        else:
+            changed = len(self.prices) - hi
+            del self.prices[hi:]
+            del self.volumes[hi:]
+
+        for price in [p for p in self.prices if p not in rows]:
+            changed += self.update(price, 0)
+        for price, volume in rows.iteritems():
+            changed += self.update(price, volume)
+        return changed
+
+
+class OrderBook(object):
+    '''
+    Incrementally maintained order book of one pair.
+    '''
+
+    def __init__(self, pair):
+        self.pair = pair
+        self.asks = BookSide(bids=False)
+        self.bids = BookSide(bids=True)
+        self.updated = None
+
+
+    def replace(self, asks, bids, timestamp=None):
+        """
+        Rebuilds both sides from scratch.
+        """
+        self.asks.replace(asks)
+        self.bids.replace(bids)
+        self.updated = timestamp or time.time()
+
+
+    def applySnapshot(self, asks, bids, timestamp=None):
+        """
+        Applies the difference to a newer snapshot in place and returns
+        the number of changed levels.
+        """
+        changed = self.asks.applySnapshot(asks) + self.bids.applySnapshot(bids)
+        self.updated = timestamp or time.time()
+        return changed
+
+
+    def update(self, side, price, volume):
+        """
+        Sets a single level; ``side`` is "ask" or "bid".
+        """
+        book = self.asks if side == "ask" else self.bids
+        return book.update(price, volume)
+
+
+    def bestAsk(self):
+        return self.asks.best()
+
+
+    def bestBid(self):
+        return self.bids.best()
+
+
+    def spread(self):
+        ask, bid = self.asks.best(), self.bids.best()
+        if ask is None or bid is None:
+            return None
+        return ask[0] - bid[0]
+
+
+    def depthAt(self, price):
+        """
+        Volume resting at ``price`` on either side.
+        """
+        return self.asks.volumeAt(price) or self.bids.volumeAt(price)
+
+
+    def asTuples(self, depth=None):
+        """
+        Returns (asks, bids) as fresh lists of (price, volume) tuples.
+        """
+        return self.asks.levels(depth), self.bids.levels(depth)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+import threading
+
+
+class _Page(object):
+    __slots__ = ("thread", "result", "error")
+
+    def __init__(self):
+        self.thread = None
+        self.result = None
+        self.error = None
+
+
+class CursorPager(object):
+    '''
+    Iterates over the pages of a ``since`` cursor endpoint.
+
+    ``fetch(since)`` returns a tuple (batch, last) where ``last`` is the
+    cursor of the following page.  Batches are yielded as they arrive and
+    dropped afterwards, so memory stays flat however long the history is.
+    ``last`` is the cursor after the most recently yielded batch; a
+    backfill that persists it can resume with ``since=last`` after a
+    crash.  Iteration stops on an empty batch, when the cursor stops
+    advancing or once a batch reaches the epoch time ``until`` (that batch
+    is cut at ``until``).  With ``prefetch`` the next page is requested in
+    a background thread while the caller processes the current one.
+    '''
+
+    def __init__(self, fetch, since=None, until=None, prefetch=False):
+        self.fetch = fetch
+        self.last = since
+        self.until = until
+        self.prefetch = prefetch
+        self.pages = 0
+        self._pending = None
+        self._done = False
+
+
+    def __iter__(self):
+        return self
+
+
+    def _start(self, since):
+        page = _Page()
+
+        def run():
+            try:
+                page.result = self.fetch(since)
+            except Exception as e:
+                page.error = e
+
+        page.thread = threading.Thread(target=run)
+        page.thread.daemon = True
+        page.thread.start()
+        return page
+
+
+    def _next(self, since):
+        page, self._pending = self._pending, None
+        if page is None:
+            return self.fetch(since)
+        page.thread.join()
+        if page.error is not None:
+            raise page.error
+        return page.result
+
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+
+        since = self.last
+        batch, last = self._next(since)
+        if not len(batch):
+            self._done = True
+            raise StopIteration
+
+        if self.until is not None and batch.times[-1] >= self.until:
+            self._done = True
+            batch = batch[:sum(1 for t in batch.times if t < self.until)]
+        if last == since:
+            self._done = True
+
+        self.pages += 1
+        self.last = last
+        if not self._done and self.prefetch:
+            self._pending = self._start(last)
+        if not len(batch):
+            raise StopIteration
+        return batch
+
+    __next__ = next
+
+
+    def close(self):
+        """
+        Stops the iteration, waiting for a prefetch still in flight.
+        """
+        self._done = True
+        page, self._pending = self._pending, None
+        if page is not None:
+            page.thread.join()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from xcptions import (InvalidTradeAmountException, InvalidTradePairException,
+                      InvalidTradeTypeException)
+
+import decimal
+
+
+class Quantizer(object):
+    '''
+    Truncates amounts to a fixed number of decimals and formats them for
+    the API.
+
+    All arithmetic runs in a private decimal context, so the global
+    context is neither read nor modified.  Integers passed to the *Fixed
+    methods count quanta (10 ** -digits) and are formatted without any
+    Decimal arithmetic.
+    '''
+
+    __slots__ = ("digits", "quantum", "scale", "_context")
+
+    def __init__(self, digits, rounding=decimal.ROUND_DOWN):
+        self.digits = digits
+        self.scale = 10 ** digits
+        self.quantum = decimal.Decimal(1).scaleb(-digits)
+        self._context = decimal.Context(prec=34, rounding=rounding)
+
+
+    def _decimal(self, value):
+        if isinstance(value, decimal.Decimal):
+            return value
+        if isinstance(value, float):
+            # repr is the shortest string that round-trips, str drops digits
+            return decimal.Decimal(repr(value))
+        return decimal.Decimal(value)
+
+
+    def truncate(self, value):
+        """
+        Returns ``value`` cut to ``digits`` decimals as a Decimal.
+        """
+        return self._decimal(value).quantize(self.quantum,
+                                             context=self._context)
+
+
+    def toFixed(self, value):
+        """
+        Returns ``value`` as an integer number of quanta.
+        """
+        if isinstance(value, (int, long)):
+            return value * self.scale
+        return int(self.truncate(value).scaleb(self.digits,
+                                               context=self._context))
+
+
+    def fromFixed(self, units):
+        return decimal.Decimal(units).scaleb(-self.digits,
+                                             context=self._context)
+
+
+    def formatFixed(self, units):
+        """
+        Formats an integer number of quanta like format.
+        """
+        sign = "-" if units < 0 else ""
+        whole, frac = divmod(abs(units), self.scale)
+        if not frac:
+            return "%s%d.0" % (sign, whole)
+        frac = ("%0*d" % (self.digits, frac)).rstrip("0")
+        return "%s%d.%s" % (sign, whole, frac)
+
+
+    def format(self, value):
+        """
+        Truncates ``value`` and formats it without trailing zeros, keeping
+        at least one decimal ("1.5", "2.0").
+        """
+        return self.formatFixed(self.toFixed(value))
+
+
+class PairQuantizers(object):
+    '''
+    Price and volume quantizers of every pair, compiled once from a
+    metadata.MarketMetadata index.  Pairs with the same number of decimals
+    share one Quantizer.
+    '''
+
+    def __init__(self, metadata, rounding=decimal.ROUND_DOWN):
+        self.metadata = metadata
+        by_digits = {}
+        self._pairs = {}
+        for name, p in metadata.pairs.iteritems():
+            quantizers = []
+            for digits in (p.pair_decimals, p.lot_decimals):
+                q = by_digits.get(digits)
+                if q is None:
+                    q = by_digits[digits] = Quantizer(digits, rounding)
+                quantizers.append(q)
+            self._pairs[name] = tuple(quantizers)
+
+
+    def price(self, pair):
+        return self._pairs[self.metadata.resolve(pair)][0]
+
+
+    def volume(self, pair):
+        return self._pairs[self.metadata.resolve(pair)][1]
+
+
+    def formatOrder(self, pair, trade_type, rate, amount):
+        """
+        Validates one order and returns its AddOrder parameters with price
+        and volume truncated and formatted.  ``rate`` None means a market
+        order.
+        """
+        name = self.metadata.resolve(pair)
+        if trade_type not in ("buy", "sell"):
+            raise InvalidTradeTypeException("Unrecognized trade type: %r"
+                                            % trade_type)
+
+        price_q, volume_q = self._pairs[name]
+        units = volume_q.toFixed(amount)
+        minimum = self.metadata.pairs[name].ordermin
+        if minimum is not None and units < volume_q.toFixed(minimum):
+            msg = "Trade amount %r too small; should be >= %s" % \
+                  (amount, volume_q.format(minimum))
+            raise InvalidTradeAmountException(msg)
+
+        order = {"pair": name, "type": trade_type,
+                 "volume": volume_q.formatFixed(units)}
+        if rate is None:
+            order["ordertype"] = "market"
+        else:
+            order["ordertype"] = "limit"
+            order["price"] = price_q.format(rate)
+        return order
+
+
+    def formatOrders(self, orders):
+        """
+        Validates and formats a batch of (pair, trade_type, rate, amount)
+        tuples.  Returns (formatted, errors): the parameters of all valid
+        orders in input order and a list of (index, exception) for the
+        rejected ones.
+        """
+        formatted = []
+        errors = []
+        for i, order in enumerate(orders):
+            try:
+                formatted.append(self.formatOrder(*order))
+            except (InvalidTradeAmountException, InvalidTradePairException,
+                    InvalidTradeTypeException, decimal.InvalidOperation) as e:
+                errors.append((i, e))
+        return formatted, errors
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from heapq import heapify, heappop, heappush
+from itertools import count
+from xcptions import RateLimitError
+
+import threading
+import time
+
+
+HIGH = 0
+NORMAL = 5
+LOW = 9
+
+
+class DecayingCounter(object):
+    '''
+    Call counter that grows by the cost of every call and shrinks by
+    ``decay`` per second; a call is allowed while the counter stays at or
+    below ``limit``.
+    '''
+
+    __slots__ = ("limit", "decay", "_level", "_stamp")
+
+    def __init__(self, limit, decay):
+        self.limit = limit
+        self.decay = decay
+        self._level = 0.0
+        self._stamp = time.time()
+
+
+    def level(self, now=None):
+        if now is None:
+            now = time.time()
+        return max(0.0, self._level - (now - self._stamp) * self.decay)
+
+
+    def wait(self, cost, now=None):
+        """
+        Seconds until a call of ``cost`` fits under the limit.
+        """
+        excess = self.level(now) + cost - self.limit
+        return excess / self.decay if excess > 0 else 0.0
+
+
+    def add(self, cost, now=None):
+        if now is None:
+            now = time.time()
+        self._level = self.level(now) + cost
+        self._stamp = now
+
+
+    def saturate(self, now=None):
+        """
+        Assumes the server-side counter is full, e.g. after a rate limit
+        error.
+        """
+        if now is None:
+            now = time.time()
+        self._level = max(self.level(now), float(self.limit))
+        self._stamp = now
+
+
+class _Bucket(object):
+    __slots__ = ("counter", "waiters")
+
+    def __init__(self, limit, decay):
+        self.counter = DecayingCounter(limit, decay)
+        self.waiters = []
+
+
+class RateLimiter(object):
+    '''
+    Local model of Kraken's call counters with priority scheduling.
+
+    Private calls count against a counter per API key, public calls
+    against one per IP address.  Callers of acquire() wait exactly until
+    their call fits under the counter's limit; while several wait for the
+    same counter the one with the lowest priority value goes first, ties in
+    arrival order.  Orders and cancellations default to HIGH, history
+    backfills to LOW.  The defaults match a starter tier key.
+    '''
+
+    COSTS = {
+        "Ledgers": 2,
+        "QueryLedgers": 2,
+        "TradesHistory": 2,
+        # handled by the matching engine's own limiter
+        "AddOrder": 0,
+        "CancelOrder": 0,
+    }
+
+    PRIORITIES = {
+        "AddOrder": HIGH,
+        "CancelOrder": HIGH,
+        "OpenOrders": HIGH,
+        "Trades": LOW,
+        "OHLC": LOW,
+        "Ledgers": LOW,
+        "TradesHistory": LOW,
+        "ClosedOrders": LOW,
+        "Balance": LOW,
+        "TradeBalance": LOW,
+    }
+
+    def __init__(self, key_limit=15, key_decay=1 / 3.0, ip_limit=1,
+                 ip_decay=1.0, costs=None, priorities=None):
+        self.key_limit = key_limit
+        self.key_decay = key_decay
+        self.costs = dict(self.COSTS if costs is None else costs)
+        self.priorities = dict(self.PRIORITIES if priorities is None
+                               else priorities)
+        self._cond = threading.Condition(threading.Lock())
+        self._ip = _Bucket(ip_limit, ip_decay)
+        self._keys = {}
+        self._seq = count()
+
+
+    def cost(self, command):
+        return self.costs.get(command, 1)
+
+
+    def _bucket(self, key):
+        # caller holds self._cond
+        if key is None:
+            return self._ip
+        bucket = self._keys.get(key)
+        if bucket is None:
+            bucket = self._keys[key] = _Bucket(self.key_limit,
+                                               self.key_decay)
+        return bucket
+
+
+    def acquire(self, command, key=None, priority=None, timeout=None):
+        """
+        Blocks until ``command`` may be sent for ``key`` (None for public
+        calls) and books its cost.  Returns the seconds waited.  Raises
+        RateLimitError if ``timeout`` seconds pass first.
+        """
+        cost = self.cost(command)
+        if priority is None:
+            priority = self.priorities.get(command, NORMAL)
+
+        started = time.time()
+        entry = (priority, next(self._seq))
+        with self._cond:
+            bucket = self._bucket(key)
+            heappush(bucket.waiters, entry)
+            try:
+                while True:
+                    now = time.time()
+                    wait = None
+                    if bucket.waiters[0] == entry:
+                        wait = bucket.counter.wait(cost, now)
+                        if wait <= 0:
+                            heappop(bucket.waiters)
+                            bucket.counter.add(cost, now)
+                            self._cond.notify_all()
+                            return now - started
+
+                    if timeout is not None:
+                        left = started + timeout - now
+                        if left <= 0:
+                            raise RateLimitError(["Local rate limit: %s "
+                                                  "not sent within %ss"
+                                                  % (command, timeout)])
+                        wait = left if wait is None else min(wait, left)
+                    self._cond.wait(wait)
+            except BaseException:
+                if entry in bucket.waiters:
+                    bucket.waiters.remove(entry)
+                    heapify(bucket.waiters)
+                    self._cond.notify_all()
+                raise
+
+
+    def saturate(self, key=None):
+        """
+        Marks the counter of ``key`` (None for the IP counter) as full, to
+        be called when the server reported a rate limit error.
+        """
+        with self._cond:
+            self._bucket(key).counter.saturate()
+
+
+    def levels(self):
+        """
+        Current counter level per key, with the IP counter under None.
+        """
+        now = time.time()
+        with self._cond:
+            levels = dict((key, b.counter.level(now))
+                          for key, b in self._keys.iteritems())
+            levels[None] = self._ip.counter.level(now)
+            return levels
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+import httplib
+import random
+import socket
+import time
+
+from xcptions import APIResponseError, PoolTimeoutError
+
+
+class RetryPolicy(object):
+    '''
+    Decides whether and when a failed request is sent again.
+
+    Waits grow exponentially from ``backoff`` up to ``max_backoff`` seconds
+    and are shortened by a random share of up to ``jitter`` so reconnecting
+    clients spread out.  ``deadline`` caps the wall time of one call,
+    including all attempts and waits; None means no budget.
+    '''
+
+    # HTTP codes worth another attempt; everything else is the caller's fault
+    RETRY_STATUS = (429, 500, 502, 503, 504, 520, 522, 524)
+
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=5.0,
+                 jitter=0.5, deadline=None):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+
+
+    def isRetryable(self, exc, idempotent, sent):
+        """
+        A request that may have reached the server is only repeated if it is
+        idempotent; a signed private POST is never sent twice.
+        """
+        if sent and not idempotent:
+            return False
+        if isinstance(exc, APIResponseError):
+            return exc.status in self.RETRY_STATUS
+        return isinstance(exc, (socket.error, httplib.HTTPException,
+                                PoolTimeoutError))
+
+
+    def delay(self, attempt):
+        """
+        Seconds to wait after the given (1-based) failed attempt.
+        """
+        wait = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return wait * (1 - self.jitter * random.random())
+
+
+    def remaining(self, started, deadline=None):
+        """
+        Seconds left of the call's budget, or None without a deadline.
+        """
+        if deadline is None:
+            deadline = self.deadline
+        if deadline is None:
+            return None
+        return deadline - (time.time() - started)
+
+
+    def nextDelay(self, exc, attempt, idempotent, sent, started,
+                  deadline=None):
+        """
+        Returns the seconds to wait before the next attempt, or None if the
+        call should fail with ``exc``.
+        """
+        if attempt >= self.max_attempts:
+            return None
+        if not self.isRetryable(exc, idempotent, sent):
+            return None
+
+        wait = self.delay(attempt)
+        left = self.remaining(started, deadline)
+        if left is not None and wait >= left:
+            return None
+        return wait
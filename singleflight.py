@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+import threading
+
+
+class _Call(object):
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    Coalesces concurrent identical calls.
+
+    The first caller of do() for a key runs the function; callers arriving
+    with the same key while it runs wait and receive its result (or its
+    exception) instead of running it again.  If the first caller is
+    interrupted, e.g. by KeyboardInterrupt, the others get a RuntimeError.  Nothing is kept once the call
+    returned, so results are never stale.  All callers share the same
+    result object and must not modify it.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+
+    def do(self, key, fn):
+        """
+        Returns fn(), shared with every concurrent caller using ``key``.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if isinstance(call.error, Exception):
+                raise call.error
+            if call.error is not None:
+                # KeyboardInterrupt, SystemExit etc. belong to the leader
+                raise RuntimeError("Shared call for %r was interrupted: %r"
+                                   % (key, call.error))
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
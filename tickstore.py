@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from array import array
+from columnar import OHLCVFrame, column
+from contextlib import contextmanager
+
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+ITEMSIZE = struct.calcsize('d')
+
+
+def searchSorted(values, x, right=False):
+    """
+    Index at which ``x`` would be inserted into the sorted ``values``,
+    before equal entries or, with ``right``, after them.
+    """
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return int(numpy.searchsorted(values, x,
+                                      side='right' if right else 'left'))
+    lo, hi = 0, len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if values[mid] < x or (right and values[mid] == x):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class _MappedColumn(object):
+    '''
+    Read-only float64 sequence over a memory-mapped column file, used when
+    NumPy is not installed.
+    '''
+
+    __slots__ = ("_map", "_length")
+
+    def __init__(self, mapped, length):
+        self._map = mapped
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        return struct.unpack_from('d', self._map, index * ITEMSIZE)[0]
+
+    def slice(self, start, stop):
+        values = array('d')
+        values.fromstring(self._map[start * ITEMSIZE:stop * ITEMSIZE])
+        return values
+
+
+class TickSeries(object):
+    '''
+    Append-only candles of one pair and interval.
+
+    Every column of columnar.OHLCVFrame lives in its own file of native
+    float64 values (trade counts included) in ``directory``.  The times
+    column is the index: candles are appended in time order only, so a
+    range query is two binary searches on the mapped times followed by
+    slicing every column.  With NumPy the slices are views of the mapped
+    files, without it they are copied into ``array.array`` columns.
+    Appends write the times column last, and on opening and before every
+    append all columns are cut to the shortest one, so a failed or crashed
+    append loses at most its own candles.  Writers hold locked(), a lock
+    of the series shared by the threads of this process and, where fcntl
+    is available, by other processes through a lock file.
+    '''
+
+    def __init__(self, directory, pair, interval):
+        self.directory = directory
+        self.pair = pair
+        self.interval = interval
+        self.step = interval * 60
+        self._lock = threading.Lock()
+        self._writeLock = threading.RLock()
+        self._writers = 0
+        self._lockFile = None
+        self._maps = None
+        self._length = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._paths = dict((name, os.path.join(directory, name + ".f8"))
+                           for name in OHLCVFrame.COLUMNS)
+        with self.locked():
+            self._repair()
+
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the write lock of the series, e.g. around reading last() and
+        appending what is missing after it.  Reentrant within a thread.
+        """
+        with self._writeLock:
+            self._writers += 1
+            try:
+                # flock conflicts between descriptors of the same process,
+                # so only the outermost holder takes it
+                if self._writers == 1 and fcntl is not None:
+                    self._lockFile = open(os.path.join(self.directory,
+                                                       ".lock"), 'a')
+                    fcntl.flock(self._lockFile, fcntl.LOCK_EX)
+                yield
+            finally:
+                self._writers -= 1
+                if not self._writers and self._lockFile is not None:
+                    # closing the file releases the flock
+                    self._lockFile.close()
+                    self._lockFile = None
+
+
+    def _repair(self):
+        # cuts all columns to the shortest one; caller holds locked()
+        sizes = dict((path, os.path.getsize(path)
+                      if os.path.exists(path) else 0)
+                     for path in self._paths.itervalues())
+        size = min(sizes.itervalues()) // ITEMSIZE * ITEMSIZE
+        for path in self._paths.itervalues():
+            if sizes[path] != size or not os.path.exists(path):
+                with open(path, 'ab') as f:
+                    f.truncate(size)
+
+
+    def __len__(self):
+        return os.path.getsize(self._paths["times"]) // ITEMSIZE
+
+
+    def _columns(self):
+        # maps the files again whenever they grew, e.g. by another process
+        length = len(self)
+        with self._lock:
+            if self._maps is None or self._length != length:
+                self._maps = self._open(length)
+                self._length = length
+            return self._maps, length
+
+
+    def _open(self, length):
+        if not length:
+            return None
+        maps = {}
+        for name, path in self._paths.iteritems():
+            if numpy is not None:
+                maps[name] = numpy.memmap(path, dtype='float64', mode='r',
+                                          shape=(length,))
+            else:
+                with open(path, 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), length * ITEMSIZE,
+                                       access=mmap.ACCESS_READ)
+                maps[name] = _MappedColumn(mapped, length)
+        return maps
+
+
+    def first(self):
+        maps, length = self._columns()
+        return float(maps["times"][0]) if length else None
+
+
+    def last(self):
+        maps, length = self._columns()
+        return float(maps["times"][-1]) if length else None
+
+
+    def append(self, frame):
+        """
+        Appends the candles of ``frame`` after the last stored one; older
+        candles are skipped.  Returns the number of candles appended.
+        """
+        with self.locked():
+            # a failed append, here or in another process, leaves value
+            # columns longer than the times
+            self._repair()
+            last = self.last()
+            begin = 0 if last is None else searchSorted(frame.times, last,
+                                                        right=True)
+            if begin >= len(frame):
+                return 0
+
+            names = [n for n in OHLCVFrame.COLUMNS
+                     if n != "times"] + ["times"]
+            for name in names:
+                values = getattr(frame, name)[begin:]
+                if numpy is not None:
+                    data = numpy.asarray(values, dtype='float64').tostring()
+                else:
+                    data = array('d', values).tostring()
+                with open(self._paths[name], 'ab') as f:
+                    f.write(data)
+            return len(frame) - begin
+
+
+    def range(self, start=None, stop=None):
+        """
+        Candles with ``start`` <= time < ``stop`` (epoch seconds, None for
+        open ends) as a columnar.OHLCVFrame.
+        """
+        maps, length = self._columns()
+        if not length:
+            return OHLCVFrame.empty(self.pair)
+
+        times = maps["times"]
+        lo = 0 if start is None else searchSorted(times, start)
+        hi = length if stop is None else searchSorted(times, stop)
+        hi = max(lo, hi)
+
+        columns = {}
+        for name in OHLCVFrame.COLUMNS:
+            if numpy is not None:
+                values = maps[name][lo:hi]
+                columns[name] = values.astype('int64') \
+                                if name == "counts" else values
+            else:
+                values = maps[name].slice(lo, hi)
+                columns[name] = column(values, 'l') \
+                                if name == "counts" else values
+        return OHLCVFrame(self.pair, **columns)
+
+
+    def gaps(self, start, stop):
+        """
+        Spans (begin, end) of candle times in [start, stop) missing from the
+        store: before the first candle, between candles further apart than
+        one interval and after the last candle.
+        """
+        maps, length = self._columns()
+        if not length:
+            return [(start, stop)] if start < stop else []
+
+        # a candle at t covers [t, t + step)
+        times = maps["times"]
+        lo = searchSorted(times, start - self.step, right=True)
+        hi = searchSorted(times, stop)
+        if lo >= hi:
+            return [(start, stop)] if start < stop else []
+
+        spans = []
+        if times[lo] > start:
+            spans.append((start, float(times[lo])))
+
+        if numpy is not None:
+            window = times[lo:hi]
+            for i in numpy.nonzero(numpy.diff(window) > self.step)[0]:
+                spans.append((float(window[i]) + self.step,
+                              float(window[i + 1])))
+        else:
+            prev = times[lo]
+            for i in xrange(lo + 1, hi):
+                t = times[i]
+                if t - prev > self.step:
+                    spans.append((prev + self.step, t))
+                prev = t
+
+        tail = float(times[hi - 1]) + self.step
+        if tail < stop:
+            spans.append((tail, stop))
+        return spans
+
+
+class TickStore(object):
+    '''
+    Directory of TickSeries, one subdirectory per pair and interval.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._series = {}
+
+
+    def series(self, pair, interval=1):
+        with self._lock:
+            series = self._series.get((pair, interval))
+            if series is None:
+                series = self._series[(pair, interval)] = TickSeries(
+                    os.path.join(self.root, pair, str(interval)), pair,
+                    interval)
+            return series
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+import datetime
+import decimal
+import math
+import time
+
+
+# local datetimes of whole epoch seconds; history pages carry many records
+# per second, so most conversions become a dict hit plus replace()
+_SECONDS = {}
+_SECONDS_MAX = 65536
+
+_fromtimestamp = datetime.datetime.fromtimestamp
+
+
+def fromEpoch(ts):
+    """
+    Same result as datetime.datetime.fromtimestamp(ts) for a local time,
+    served from a per-second cache.
+    """
+    sec = int(math.floor(ts))
+    us = int(round((ts - sec) * 1e6))
+    if us >= 1000000:
+        sec += 1
+        us -= 1000000
+
+    dt = _SECONDS.get(sec)
+    if dt is None:
+        if len(_SECONDS) >= _SECONDS_MAX:
+            _SECONDS.clear()
+        dt = _SECONDS[sec] = _fromtimestamp(sec)
+    if us:
+        return dt.replace(microsecond=us)
+    return dt
+
+
+def parseDateTime(s):
+    """
+    Parses "%Y-%m-%d %H:%M:%S" with an optional ".%f" fraction by slicing
+    the fixed positions instead of going through strptime.
+    """
+    if len(s) < 19 or s[4] != "-" or s[7] != "-" or s[13] != ":":
+        raise ValueError("time data %r does not match format "
+                         "'%%Y-%%m-%%d %%H:%%M:%%S[.%%f]'" % s)
+
+    us = 0
+    if len(s) > 19:
+        if s[19] != ".":
+            raise ValueError("unconverted data remains: %s" % s[19:])
+        frac = s[20:26]
+        us = int(frac) * 10 ** (6 - len(frac))
+
+    return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                             int(s[11:13]), int(s[14:16]), int(s[17:19]), us)
+
+
+def toDateTime(value):
+    """
+    Converts an epoch number or a date string into a datetime.  datetimes
+    and None are passed through.
+    """
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, basestring):
+        return parseDateTime(value)
+    if isinstance(value, decimal.Decimal):
+        value = float(value)
+    return fromEpoch(value)
+
+
+def toEpoch(value):
+    """
+    Converts an epoch number, a date string or a local datetime into epoch
+    seconds as a float.
+    """
+    if isinstance(value, basestring):
+        value = parseDateTime(value)
+    if isinstance(value, datetime.datetime):
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+    return float(value)
+
+
+def toDateTimes(values):
+    """
+    Converts a sequence of epoch numbers (a list, array or NumPy array)
+    into a list of datetimes.
+    """
+    convert = fromEpoch
+    return [convert(v) for v in values]
+
+
+def materialize(records, attribute="date"):
+    """
+    Converts the lazy ``attribute`` of all records in one pass.
+    """
+    for r in records:
+        getattr(r, attribute)
+
+
+class LazyDate(object):
+    '''
+    Descriptor for date attributes of the model classes.
+
+    The raw epoch or date string is kept in the ``slot`` attribute, so the
+    pickled state of a model holds the raw value.  The datetime is built
+    on first access and kept in the ``slot`` + "_cache" attribute, which the
+    model classes leave out of their state.  raw() reads the raw value.
+    '''
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.cache = slot + "_cache"
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = getattr(obj, self.cache, None)
+        if value is None:
+            value = toDateTime(getattr(obj, self.slot))
+            setattr(obj, self.cache, value)
+        return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+        setattr(obj, self.cache, None)
+
+    def raw(self, obj):
+        """
+        The raw value of ``obj``, without converting it.
+        """
+        return getattr(obj, self.slot)
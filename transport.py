@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Jens Lorrmann
+
+
+from connection import ConnectionPool, proxySettings
+from functools import partial
+
+import httplib
+import socket
+import ssl
+import threading
+
+
+class SharedTLSConnection(httplib.HTTPSConnection):
+    '''
+    HTTPSConnection using a shared SSLContext, which loads the CA
+    certificates once instead of per socket.  Without a ``context`` the
+    one of the TRANSPORTS registry is used.
+    '''
+
+    def __init__(self, host, port=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 context=None):
+        if context is None:
+            context = TRANSPORTS.context
+        httplib.HTTPSConnection.__init__(self, host, port, timeout=timeout,
+                                         context=context)
+        self._context = context
+
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port),
+                                        self.timeout, self.source_address)
+        if self._tunnel_host:
+            self.sock = sock
+            self._tunnel()
+
+        self.sock = self._context.wrap_socket(
+            sock, server_hostname=self._tunnel_host or self.host)
+
+
+class TransportRegistry(object):
+    '''
+    Process-wide connection pools shared by all exchange instances.
+
+    Pools are keyed by domain, proxy settings and connection class, so
+    every exchange object talking to the same API through the same proxy
+    uses the same sockets.  acquire() hands out a pool and counts a
+    reference, release() drops it and closes the pool with the last one.
+    HTTPS pools share one SSLContext.  A pool grows to the largest size
+    requested for it.
+    '''
+
+    def __init__(self, context=None):
+        self._context = context
+        self._lock = threading.Lock()
+        # key -> [pool, references]
+        self._pools = {}
+
+
+    @property
+    def context(self):
+        with self._lock:
+            if self._context is None:
+                self._context = ssl.create_default_context()
+            return self._context
+
+
+    def acquire(self, domain, size=4, timeout=30, idle_timeout=60,
+                connection_class=None):
+        """
+        Returns the shared pool for ``domain``; pair every call with
+        release(pool).
+        """
+        if connection_class is None:
+            connection_class = partial(SharedTLSConnection,
+                                       context=self.context)
+            key = (domain, proxySettings(), None)
+        else:
+            key = (domain, proxySettings(), connection_class)
+
+        with self._lock:
+            entry = self._pools.get(key)
+            if entry is None or entry[0].closed:
+                entry = self._pools[key] = [ConnectionPool(
+                    domain, size=size, timeout=timeout,
+                    idle_timeout=idle_timeout,
+                    connection_class=connection_class), 0]
+            elif size > entry[0].size:
+                entry[0].resize(size)
+            entry[1] += 1
+            return entry[0]
+
+
+    def release(self, pool):
+        with self._lock:
+            for key, entry in self._pools.items():
+                if entry[0] is pool:
+                    entry[1] -= 1
+                    if entry[1] > 0:
+                        return
+                    del self._pools[key]
+                    break
+        pool.close()
+
+
+    def stats(self):
+        """
+        One dict per pool: domain, proxy, references, size and idle
+        sockets.
+        """
+        with self._lock:
+            return [{"domain": key[0], "proxy": key[1], "references": refs,
+                     "size": pool.size, "idle": pool.idle()}
+                    for key, (pool, refs) in self._pools.iteritems()]
+
+
+    def close(self):
+        """
+        Closes all pools, e.g. at shutdown.
+        """
+        with self._lock:
+            entries, self._pools = self._pools.values(), {}
+        for pool, _ in entries:
+            pool.close()
+
+
+TRANSPORTS = TransportRegistry()
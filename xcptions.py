@@ -20,17 +20,21 @@ class InvalidTradeAmountException(Exception):
 class APIResponseError(Exception):
     """ Exception raise if the API replies with an HTTP code
     not in the 2xx range. """
-    pass
+    def __init__(self, msg, status=None):
+        Exception.__init__(self, msg)
+        self.status = status
 
 
 class InvalidNonceException(Exception):
-    def __init__(self, method, expectedNonce, actualNonce):
+    def __init__(self, method, expectedNonce=None, actualNonce=None):
         Exception.__init__(self)
         self.method = method
         self.expectedNonce = expectedNonce
         self.actualNonce = actualNonce
 
     def __str__(self):
+        if self.expectedNonce is None:
+            return self.method
         return "Expected a nonce greater than %d" % self.expectedNonce
 
 
@@ -38,3 +42,62 @@ class InvalidSortOrderException(Exception):
     ''' Exception thrown when an invalid sort order is passed '''
     pass
 
+
+
+class PoolTimeoutError(Exception):
+    """ Exception raised if no pooled connection became available in time
+    or the pool has been closed. """
+    pass
+
+
+class APIError(Exception):
+    """ Exception raised if the API reports errors in its response
+    envelope.  ``errors`` holds the messages as sent by the API. """
+    def __init__(self, errors):
+        Exception.__init__(self, "; ".join(errors))
+        self.errors = errors
+
+
+class GeneralAPIError(APIError):
+    """ EGeneral: invalid arguments, permission denied, ... """
+    pass
+
+
+class APIKeyError(APIError):
+    """ EAPI: invalid key, signature or nonce, rate limit exceeded. """
+    pass
+
+
+class APINonceError(APIKeyError):
+    """ EAPI:Invalid nonce """
+    pass
+
+
+class RateLimitError(APIKeyError):
+    """ EAPI:Rate limit exceeded or EOrder:Rate limit exceeded """
+    pass
+
+
+class QueryError(APIError):
+    """ EQuery: unknown asset pair or asset. """
+    pass
+
+
+class OrderError(APIError):
+    """ EOrder/ETrade: the order was refused. """
+    pass
+
+
+class FundingError(APIError):
+    """ EFunding: deposit or withdrawal refused. """
+    pass
+
+
+class ServiceError(APIError):
+    """ EService: the API is unavailable or busy. """
+    pass
+
+
+class KeyPoolError(Exception):
+    """ Exception raised if no key of a key pool may run a query. """
+    pass